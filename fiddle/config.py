@@ -451,6 +451,26 @@ class Main(ConfigObject):
     cc = ""
     runtime = {}
     verbose = False
+    # cross-check every statically disassembled instruction with radare2
+    static_r2_crosscheck = False
+    # static analysis databases shared between test instances ("" disables)
+    staticdb_cache = "{Main.root}/staticdb_cache"
+    staticdb_cache_size = 4 << 30
+    # only re-analyze functions that changed since the stage's last cached staticdb
+    static_incremental = False
+    # processes sharing the static write search (0 for one per core), and
+    # roughly how many bytes of code each of them is handed at a time
+    static_workers = 0
+    static_shard_size = 64 << 10
+    # radare2 processes kept per ELF, and where their analysis is saved as
+    # projects so it isn't redone on every run ("" disables)
+    r2_pool_size = 4
+    r2_projects = "{Main.root}/r2_projects"
+    # traced writes the hookwrite plugin collects before writing them out
+    trace_write_buffer_rows = 1 << 16
+    # python that runs the process gdb hands traced writes to for writing
+    # out ("" writes them from inside gdb)
+    trace_writer = "python2"
 
     def __init__(self, kw, name=None, default=False):
         self.default = default
@@ -483,6 +503,10 @@ class Main(ConfigObject):
         self._update_raw("cc", self.cc)
         self.test_data_path = self.populate_path(self.test_data_path)
         self._update_raw("test_data_path", self.test_data_path)
+        if self.staticdb_cache:
+            self.staticdb_cache = self.populate_path(self.staticdb_cache)
+        if self.r2_projects:
+            self.r2_projects = self.populate_path(self.r2_projects)
 
     def setup(self):
         if self.attr_exists("setup_done"):
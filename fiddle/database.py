@@ -41,6 +41,8 @@ import sys
 import pure_utils
 from capstone import *
 import os
+import time
+import numpy
 l = logging.getLogger("")
 
 
@@ -231,6 +233,37 @@ class WriteDstTable():
             r['origpchi'] = utils.addr_hi(long(r['origpc']))
             r.append()
 
+    def add_dsts_entries(self, columns):
+        # add_dsts_entry for a batch of traced writes, columns is a dict of
+        # equal-length arrays: 'lo', 'hi', 'pc', 'origpc' and 'substage'
+        lo = numpy.asarray(columns['lo']).astype(numpy.uint64)
+        hi = numpy.asarray(columns['hi']).astype(numpy.uint64)
+        pc = numpy.asarray(columns['pc']).astype(numpy.uint64)
+        origpc = numpy.asarray(columns['origpc']).astype(numpy.uint64)
+        origpc = numpy.where(origpc == 0, pc, origpc)
+        nums = numpy.asarray(columns['substage'])
+        keep = (lo < hi) & (pc != 0)
+        if not keep.all():
+            print "dropping %d empty or pc-less write ranges" % (len(keep) - keep.sum())
+        line = WriteDstResult('', 0, '', []).key()
+        nonram = set((i.begin, i.end) for i in Main.get_hardwareclass_config().non_ram_ranges)
+        for num in numpy.unique(nums[keep]):
+            num = int(num)
+            if num not in self.tables.iterkeys():
+                self._init_table(num)
+            sel = keep & (nums == num)
+            rows = numpy.zeros(sel.sum(), dtype=self.tables[num].dtype)
+            for (name, values) in [('dstlo', lo[sel]), ('dsthi', hi[sel]),
+                                   ('writepc', pc[sel]), ('origpc', origpc[sel])]:
+                rows[name] = values
+                rows[name + 'lo'] = values & 0xFFFFFFFF
+                rows[name + 'hi'] = values >> 32
+            rows['dst_not_in_ram'] = [(long(l), long(h)) in nonram
+                                      for (l, h) in zip(rows['dstlo'], rows['dsthi'])]
+            rows['substage'] = num
+            rows['line'] = line
+            self.tables[num].append(rows)
+
     def print_dsts_info(self):
         self.flush_table()
         num_writes = db_info.get(self.stage).num_writes()
@@ -362,6 +395,38 @@ class TraceWriteEntry(tables.IsDescription):
     callindex = tables.UInt32Col()
 
 
+class TraceLongWriteEntry(tables.IsDescription):
+    # all the writes of one longwrite loop, rather than a writes row per word
+    index = tables.UInt32Col()  # from the same sequence as the writes table's
+    pid = tables.UInt32Col()
+    start = tables.UInt64Col()
+    startlo = tables.UInt32Col()
+    starthi = tables.UInt32Col()
+    end = tables.UInt64Col()
+    endlo = tables.UInt32Col()
+    endhi = tables.UInt32Col()
+    stride = tables.Int64Col()
+    writesize = tables.Int64Col()
+    inplace = tables.BoolCol()  # every write is to start
+    numops = tables.UInt64Col()
+    pc = tables.UInt64Col()
+    pclo = tables.UInt32Col()
+    pchi = tables.UInt32Col()
+    relocatedpc = tables.UInt64Col()
+    relocatedpclo = tables.UInt32Col()
+    relocatedpchi = tables.UInt32Col()
+    lr = tables.UInt64Col()
+    lrlo = tables.UInt32Col()
+    lrhi = tables.UInt32Col()
+    relocatedlr = tables.UInt64Col()
+    relocatedlrlo = tables.UInt32Col()
+    relocatedlrhi = tables.UInt32Col()
+    time = tables.Float64Col()
+    cpsr = tables.UInt64Col()
+    substage = tables.UInt8Col()
+    callindex = tables.UInt32Col()
+
+
 class TraceWriteRange(tables.IsDescription):
     index = tables.UInt32Col()
     destlo = tables.UInt64Col()
@@ -392,10 +457,34 @@ class TraceWriteRange(tables.IsDescription):
 
 class TraceTable():
     h5tablename = "writes"
+    longwritestablename = "longwrites"
     writerangetablename = "write_ranges"
     consolidatedwriterangetablename = "write_ranges_consolidated"
-
-    def __init__(self, outfile, stage, create=False, write=False):
+    # columns of the writes table that get a full index
+    writesindexcols = ['relocatedpclo', 'relocatedpchi', 'pclo', 'pchi',
+                       'destlo', 'desthi', 'index', 'callindex']
+    # number of writes histogram() coalesces at a time
+    histogram_chunk_rows = 1 << 20
+    # one traced write as collected by the gdb write hooks
+    write_record_dtype = numpy.dtype([('time', numpy.float64), ('pid', numpy.int64),
+                                      ('size', numpy.int64), ('dest', numpy.int64),
+                                      ('pc', numpy.int64), ('lr', numpy.int64),
+                                      ('cpsr', numpy.int64), ('origpc', numpy.int64),
+                                      ('callindex', numpy.int64), ('substage', numpy.int64)])
+    # one longwrite loop as collected by the gdb write hooks, 'before' is how
+    # many of the write records sent along with it came first
+    longwrite_record_dtype = numpy.dtype([('time', numpy.float64), ('pid', numpy.int64),
+                                          ('start', numpy.int64), ('end', numpy.int64),
+                                          ('stride', numpy.int64), ('writesize', numpy.int64),
+                                          ('inplace', numpy.bool_), ('pc', numpy.int64),
+                                          ('lr', numpy.int64), ('cpsr', numpy.int64),
+                                          ('origpc', numpy.int64), ('callindex', numpy.int64),
+                                          ('substage', numpy.int64), ('before', numpy.int64)])
+
+    def __init__(self, outfile, stage, create=False, write=False, bulk=False):
+        # in bulk mode the writes table is loaded without indexes,
+        # they are built once when the table is closed/flushed
+        self.bulk = bulk
         self.stage = stage
         self.stagename = stage.stagename
         self.cc = Main.cc
@@ -426,16 +515,13 @@ class TraceTable():
                                                         TraceWriteEntry,
                                                         "memory write information")
             self.trace_count = 1
-            self.writestable.cols.relocatedpclo.create_index(kind='full')
-            self.writestable.cols.relocatedpchi.create_index(kind='full')
-            self.writestable.cols.pclo.create_index(kind='full')
-            self.writestable.cols.pchi.create_index(kind='full')
-            self.writestable.cols.destlo.create_index(kind='full')
-            self.writestable.cols.desthi.create_index(kind='full')
-            self.writestable.cols.index.create_index(kind='full')
-            self.writestable.cols.callindex.create_index(kind='full')
+            if not self.bulk:
+                self.index_writes_table()
             self.writestable.flush()
             self.hisotable = None
+        self.longwritestable = self._open_longwrites_table()
+        # longwrites take their indexes from the same sequence as the writes
+        self.trace_count += self.longwritestable.nrows
         if self.has_histogram():
             self.histotable = getattr(self.get_group(), 'writerange')
         self.init_writerangetable()
@@ -443,6 +529,7 @@ class TraceTable():
         self._mdarm = None
 
         self._rinfos = None
+        self._relocbounds = None
         self._pcmax = None
 
     @property
@@ -463,6 +550,22 @@ class TraceTable():
             self._rinfos = staticanalysis.WriteSearch.get_relocation_information(self.stage)
         return self._rinfos
 
+    @property
+    def relocbounds(self):
+        # (start, end, offset) of each relocated range sorted by start,
+        # with the same (inclusive) bounds add_write_entry always used
+        if self._relocbounds is None:
+            bounds = []
+            for rinfo in self.rinfos:
+                offset = rinfo['reloffset']
+                start = (rinfo['startaddr']+offset)
+                end = start + rinfo['size'] + offset
+                bounds.append((start, end, offset))
+            bounds.sort()
+            self._relocbounds = tuple(numpy.array([b[i] for b in bounds], dtype=numpy.int64)
+                                      for i in range(3))
+        return self._relocbounds
+
     @property
     def mdthumb(self):
         if self._mdthumb is None:
@@ -497,8 +600,36 @@ class TraceTable():
             self._setthumbranges()
         return self._dataranges
 
+    def _open_longwrites_table(self):
+        group = self.get_group()
+        if hasattr(group, self.longwritestablename):
+            return getattr(group, self.longwritestablename)
+        table = self.h5file.create_table(group, self.longwritestablename,
+                                         TraceLongWriteEntry, "longwrite loop writes")
+        table.cols.index.create_index(kind='full')
+        table.cols.substage.create_index(kind='full')
+        table.flush()
+        return table
+
+    def index_writes_table(self, progress=False):
+        # create any missing writes table indexes
+        missing = [c for c in self.writesindexcols
+                   if not getattr(self.writestable.cols, c).is_indexed]
+        start = time.time()
+        for (i, c) in enumerate(missing):
+            if progress:
+                print "indexing %s writes column %s (%d/%d)" % (self.writestable.nrows, c,
+                                                               i + 1, len(missing))
+            getattr(self.writestable.cols, c).create_index(kind='full')
+        if progress and missing:
+            print "indexed writes table in %f seconds" % (time.time() - start)
+        self.writestable.flush()
+
     def close(self, flush_only=False):
         db_info.get(self.stage).flush_staticdb()
+        if self.bulk:
+            self.index_writes_table(True)
+            self.bulk = False
 
         print "captured %s writes" % self.writestable.nrows
         self.h5file.flush()
@@ -539,13 +670,12 @@ class TraceTable():
             rangetable.cols.index.reindex()
             rs = rangetable.read_sorted('index')
         i = 0
+        addrs = db_info.get(self.stage).addr_index()
         for rangerow in rs:
             # print "%x" % rangerow['pc']
-            (sdisasm, ssrc) = db_info.get(self.stage).disasm_and_src_from_pc(rangerow['pc'])
-            pcfname = ''
-            lrfname = ''
-            pcfname = db_info.get(self.stage).addr2functionname(rangerow['pc'])
-            lrfname = db_info.get(self.stage).addr2functionname(rangerow['lr'])
+            (sdisasm, ssrc) = addrs.disasm_and_src(long(rangerow['pc']))
+            pcfname = addrs.functionname(long(rangerow['pc']))
+            lrfname = addrs.functionname(long(rangerow['lr']))
 
             r = "pc=%x/[%x] (%s) lr=%x (%s) [%x-%x] (%d) %d times -- %s -- %s\n" % \
                 (rangerow['relocatedpc'], rangerow['pc'], pcfname, rangerow['lr'],
@@ -600,116 +730,72 @@ class TraceTable():
                 break
         if populated:
             self.writerangetable_consolidated.purge()
-        last = None
-        sortindex = 'line' if framac else 'writepclo'
-        intervals = intervaltree.IntervalTree()
-        r = None
+        sortindex = 'line' if framac else 'writepc'
         substagenums = substage.SubstagesInfo.substage_numbers(self.stage)
-        writepc = None
-        line = None
-        lvalue = None
-        dst_not_in_ram = True
         for n in substagenums:
             if n not in self.writerangetable_consolidated.tables.keys():
                 self.writerangetable_consolidated._init_table(n)
-            if n > 0:  # add last interval to previous table
-                self._add_intervals_to_table(self.writerangetable_consolidated.tables[n-1],
-                                             intervals,
-                                             writepc, line, lvalue, dst_not_in_ram,
-                                             n-1)
             print "# block writes in stage [%s]: %s" % (n, self.writerangetable.tables[n].nrows)
-
-            last = None
-            lvalue = None
-            dst_not_in_ram = True
-            writepc = None
-            line = None
-            count = 0
-            intervals = intervaltree.IntervalTree()  # clear intervals
-
-            if not framac:
-                uppers = set(self.writerangetable.tables[n].read_sorted('writepchi', field='writepchi'))
-                for u in uppers:
-                    q = "writepchi==0x%x" % u
-                    for r in self.writerangetable.tables[n].read_sorted(sortindex):
-                        if not r['writepchi'] == u:
-                            continue
-                        if not last == r[sortindex]:
-                            if last is not None:
-                                self._add_intervals_to_table(self.writerangetable_consolidated.tables[n],
-                                                             intervals,
-                                                             writepc,
-                                                             line,
-                                                             lvalue,
-                                                             dst_not_in_ram,
-                                                             n)
-                            intervals = intervaltree.IntervalTree()  # clear intervals
-                            writepc = long(r['writepc'])
-                            line = r['line']
-                            lvalue = r['lvalue']
-                            dst_not_in_ram = r['dst_not_in_ram']
-                            last = r[sortindex]
-                        if last is None:
-                            last = r[sortindex]
-                        dst_not_in_ram = dst_not_in_ram and r['dst_not_in_ram']
-                        intervals.addi(long(r['dstlo']), long(r['dsthi']))
-            else:
-                for r in self.writerangetable.tables[n].read_sorted(sortindex): # same as above. having scope troubles so copy/pasting this code
-                    if not last == r[sortindex]:
-                        if last is not None:
-                            self._add_intervals_to_table(self.writerangetable_consolidated.tables[n],
-                                                         intervals,
-                                                         writepc,
-                                                         line,
-                                                         lvalue,
-                                                         dst_not_in_ram,
-                                                         n)
-                        intervals = intervaltree.IntervalTree()  # clear intervals
-                        writepc = long(r['writepc'])
-                        line = r['line']
-                        lvalue = r['lvalue']
-                        dst_not_in_ram = r['dst_not_in_ram']
-                        last = r[sortindex]
-                    if last is None:
-                        last = r[sortindex]
-                    dst_not_in_ram = dst_not_in_ram and r['dst_not_in_ram']
-                    intervals.addi(long(r['dstlo']), long(r['dsthi']))
-
-            if intervals: # and remaining interval to last stage
-                self._add_intervals_to_table(self.writerangetable_consolidated.tables[n],
-                                             intervals,
-                                             writepc, line, lvalue, dst_not_in_ram, n)
+            table = self.writerangetable_consolidated.tables[n]
+            ranges = self._consolidated_ranges(self.writerangetable.tables[n].read(),
+                                               sortindex, table.dtype, n)
+            if len(ranges):
+                table.append(ranges)
         self.writerangetable_consolidated.flush_table()
         # for n in substagenums:
         #     print "# unique written regions for "\
         #         "stage %s: %s" % (n,
         #                                self.writerangetable_consolidated.tables[n].nrows)
 
-    def _add_intervals_to_table(self, table, intervals, pc, line, lvalue, dst, substage):
-        intervals.merge_overlaps()
-        intervals.merge_equals()
-        intervals.merge_overlaps()
-        r = table.row
-        for i in intervals:
-            r['writepc'] = pc
-            r['writepclo'] = utils.addr_lo(long(pc))
-            r['writepchi'] = utils.addr_hi(long(pc))
-            r['line'] = line
-            r['lvalue'] = lvalue
-            r['dst_not_in_ram'] = dst
-            r['substage'] = substage
-            r['dstlo'] = i.begin
-            r['dstlolo'] = utils.addr_lo(i.begin)
-            r['dstlohi'] = utils.addr_hi(i.begin)
-            r['dsthi'] = i.end
-            r['dsthilo'] = utils.addr_lo(i.end)
-            r['dsthihi'] = utils.addr_hi(i.end)
-            r.append()
+    def _consolidated_ranges(self, rows, sortindex, dtype, substage):
+        # merge the overlapping destination ranges of rows with the same
+        # sortindex value, everything else comes from the first such row
+        rows = rows[numpy.argsort(rows[sortindex], kind='mergesort')]
+        first = numpy.ones(len(rows), dtype=bool)
+        first[1:] = rows[sortindex][1:] != rows[sortindex][:-1]
+        groups = numpy.flatnonzero(first)
+        gid = numpy.cumsum(first) - 1
+        lo = rows['dstlo'].astype(numpy.int64)
+        hi = rows['dsthi'].astype(numpy.int64)
+        nonempty = hi > lo
+        (gid, lo, hi) = (gid[nonempty], lo[nonempty], hi[nonempty])
+        if not len(lo):
+            return numpy.zeros(0, dtype=dtype)
+        dst_not_in_ram = numpy.logical_and.reduceat(rows['dst_not_in_ram'], groups)
+        order = numpy.lexsort((lo, gid))
+        (gid, lo, hi) = (gid[order], lo[order], hi[order])
+        # furthest dsthi seen so far within each group, the running maximum
+        # is taken over (group, rank of dsthi) so it restarts at every group
+        his = numpy.sort(hi)
+        rank = numpy.searchsorted(his, hi)
+        reach = his[numpy.maximum.accumulate(gid * len(hi) + rank) % len(hi)]
+        start = numpy.ones(len(lo), dtype=bool)
+        start[1:] = (gid[1:] != gid[:-1]) | (lo[1:] >= reach[:-1])
+        starts = numpy.flatnonzero(start)
+        ends = numpy.append(starts[1:], len(lo)) - 1
+        g = gid[starts]
+        src = rows[groups[g]]
+        ranges = numpy.zeros(len(starts), dtype=dtype)
+        ranges['writepc'] = src['writepc']
+        ranges['writepclo'] = src['writepc'] & 0xFFFFFFFF
+        ranges['writepchi'] = src['writepc'] >> 32
+        ranges['line'] = src['line']
+        ranges['lvalue'] = src['lvalue']
+        ranges['dst_not_in_ram'] = dst_not_in_ram[g]
+        ranges['substage'] = substage
+        ranges['dstlo'] = lo[starts]
+        ranges['dstlolo'] = lo[starts] & 0xFFFFFFFF
+        ranges['dstlohi'] = lo[starts] >> 32
+        ranges['dsthi'] = reach[ends]
+        ranges['dsthilo'] = reach[ends] & 0xFFFFFFFF
+        ranges['dsthihi'] = reach[ends] >> 32
+        return ranges
 
     def has_histogram(self):
         return hasattr(self.get_group(), 'writerange')
 
     def histogram(self):
+        self.index_writes_table(True)
         group = self.get_group()
 
         if hasattr(group, 'writerange'):
@@ -719,150 +805,298 @@ class TraceTable():
                                               TraceWriteRange, "qemu memory write ranges")
         self.histotable.cols.index.create_index(kind='full')
         histotable = self.histotable
-        srcdir = Main.raw.runtime.temp_target_src_dir
-        relocatedpc = 0
-        relocatedlr = 0
-        size = 0
-        byteswritten = 0
-        destlo = 0
-        currentrow = None
-        line = ''
-        index = 0
-        push = False
-        pc = -1
-        sub = -1
-        for writerow in self.writestable.read_sorted('index'):
-            if (long(writerow['relocatedpc']) == relocatedpc) and \
-               (long(writerow['relocatedlr']) == relocatedlr) and \
-               ((destlo + byteswritten) == long(writerow['dest'])):
-                # append to current row
-                currentrow['byteswritten'] += size
-                byteswritten = currentrow['byteswritten']
-                if push:
-                    currentrow['destlo'] = currentrow['desthi'] - byteswritten
-                    currentrow['destlolo'] = utils.addr_lo(long(currentrow['destlo']))
-                    currentrow['destlohi'] = utils.addr_hi(long(currentrow['destlo']))
-                else:
-                    currentrow['desthi'] = currentrow['destlo'] + byteswritten
-                    currentrow['desthilo'] = utils.addr_lo(long(currentrow['desthi']))
-                    currentrow['desthihi'] = utils.addr_hi(long(currentrow['desthi']))
-                currentrow['numops'] += 1
-            else:
-                # create a new row
-                if currentrow is not None:
-                    if push:
-                        push = False
-                    currentrow.append()
-                # start a new row
-                currentrow = self.histotable.row
-                pc = long(writerow['pc'])
-                relocatedpc = long(writerow['relocatedpc'])
-                relocatedpclo = utils.addr_lo(relocatedpc)
-                relocatedpchi = utils.addr_hi(relocatedpc)
-                relocatedlr = long(writerow['relocatedlr'])
-                relocatedlrlo = utils.addr_lo(relocatedlr)
-                relocatedlrhi = utils.addr_hi(relocatedlr)
-                currentrow['cpsr'] = writerow['cpsr']
-                currentrow['lr'] = long(writerow['lr'])
-                currentrow['lrlo'] = utils.addr_lo(long(writerow['lr']))
-                currentrow['lrhi'] = utils.addr_hi(long(writerow['lr']))
-                lr = writerow['lr']
-                sub = writerow['substage']
-                currentrow['numops'] = 1
-                currentrow['pc'] = pc
-                currentrow['pclo'] = utils.addr_lo(pc)
-                currentrow['pchi'] = utils.addr_hi(pc)
-                currentrow['relocatedpc'] = relocatedpc
-                currentrow['relocatedpclo'] = utils.addr_lo(relocatedpc)
-                currentrow['relocatedpchi'] = utils.addr_hi(relocatedpc)
-                currentrow['relocatedlr'] = relocatedlr
-                currentrow['relocatedlrlo'] = utils.addr_lo(relocatedlr)
-                currentrow['relocatedlrhi'] = utils.addr_hi(relocatedlr)
-                currentrow['substage'] = sub
-                currentrow['index'] = index
-                index += 1
-                size = db_info.get(self.stage).pc_write_size(pc)
-                if size < 0:
-                    desthi = long(writerow['dest'])
-                    currentrow['desthi'] = desthi
-                    currentrow['desthilo'] = utils.addr_lo(desthi)
-                    currentrow['desthihi'] = utils.addr_hi(desthi)
-                    currentrow['destlo'] = long(desthi - size)
-                    currentrow['destlolo'] = utils.addr_lo(long(currentrow['destlo']))
-                    currentrow['destlohi'] = utils.addr_hi(long(currentrow['destlo']))
-                    size = -1*size
-                    push = True
-                else:
-                    push = False
-                    destlo = long(writerow['dest'])
-                    currentrow['destlo'] = destlo
-                    currentrow['destlolo'] = utils.addr_lo(destlo)
-                    currentrow['destlohi'] = utils.addr_hi(destlo)
-
-                    currentrow['desthi'] = long(destlo + size)
-                    currentrow['desthilo'] = utils.addr_lo(long(currentrow['desthi']))
-                    currentrow['desthihi'] = utils.addr_hi(long(currentrow['desthi']))
-
-                byteswritten = size
-                currentrow['byteswritten'] = size
-
-        if currentrow is not None:
-            currentrow.append()  # append last row
+        writesizes = db_info.get(self.stage).pc_write_sizes()
+        # next writerange index and the destlo of the last ascending range
+        state = {'index': 0, 'destlo': 0}
+        counts = numpy.zeros(256, dtype=numpy.int64)
+        nrows = self.writestable.nrows
+        # each longwrite is a range of its own, between the writes around it
+        if self.longwritestable.nrows:
+            longwrites = self.longwritestable.read_sorted('index')
+        else:
+            longwrites = numpy.zeros(0, dtype=self.longwritestable.dtype)
+        nextlw = 0
+        pending = None
+
+        def append(ranges):
+            histotable.append(ranges)
+            counts[:] += numpy.bincount(ranges['substage'], minlength=256)
+        for start in range(0, nrows, self.histogram_chunk_rows):
+            stop = min(start + self.histogram_chunk_rows, nrows)
+            rows = self.writestable.read_sorted('index', start=start, stop=stop)
+            if pending is not None:
+                rows = numpy.concatenate((pending, rows))
+                pending = None
+            if stop < nrows:
+                # hold back the trailing writes with the same relocated pc/lr,
+                # a range can only continue within them
+                same = (rows['relocatedpc'][1:] == rows['relocatedpc'][:-1]) & \
+                       (rows['relocatedlr'][1:] == rows['relocatedlr'][:-1])
+                breaks = numpy.flatnonzero(~same)
+                last = breaks[-1] + 1 if len(breaks) else 0
+                pending = rows[last:]
+                rows = rows[:last]
+            if not len(rows):
+                continue
+            upto = numpy.searchsorted(longwrites['index'], rows['index'][-1])
+            cuts = numpy.searchsorted(rows['index'], longwrites['index'][nextlw:upto])
+            p = 0
+            for (lw, cut) in zip(range(nextlw, upto), cuts):
+                if cut > p:
+                    append(self._histogram_ranges(rows[p:cut], writesizes, state))
+                    p = cut
+                append(self._longwrite_ranges(longwrites[lw:lw + 1], state))
+            nextlw = upto
+            if p < len(rows):
+                append(self._histogram_ranges(rows[p:], writesizes, state))
+        if nextlw < len(longwrites):
+            append(self._longwrite_ranges(longwrites[nextlw:], state))
         histotable.flush()
         histotable.reindex()
         substagenums = substage.SubstagesInfo.substage_numbers(self.stage)
         print histotable.nrows
         for i in substagenums:
             print "# block writes for substage %d: %d" % (i,
-                                                         len([n for n in histotable.where("substage == %d" % i)]))
+                                                         counts[i] if 0 <= i < len(counts) else 0)
         self.h5file.flush()
 
+    def _longwrite_ranges(self, longwrites, state):
+        # writerange rows for longwrites, one each
+        longwrites = longwrites[longwrites['numops'] > 0]
+        n = len(longwrites)
+        ranges = numpy.zeros(n, dtype=self.histotable.dtype)
+        for f in ['pc', 'lr', 'relocatedpc', 'relocatedlr']:
+            for suffix in ['', 'lo', 'hi']:
+                ranges[f + suffix] = longwrites[f + suffix]
+        for f in ['cpsr', 'substage', 'numops']:
+            ranges[f] = longwrites[f]
+        ranges['index'] = numpy.arange(state['index'], state['index'] + n)
+        state['index'] += n
+        size = longwrites['writesize'].astype(numpy.uint64)
+        ranges['byteswritten'] = longwrites['numops'] * size
+        destlo = longwrites['start']
+        desthi = numpy.where(longwrites['inplace'], destlo + size, longwrites['end'])
+        for (f, values) in [('destlo', destlo), ('desthi', desthi)]:
+            ranges[f] = values
+            ranges[f + 'lo'] = values & 0xFFFFFFFF
+            ranges[f + 'hi'] = values >> 32
+        if n:
+            state['destlo'] = long(destlo[-1])
+        return ranges
+
+    def _histogram_ranges(self, rows, writesizes, state):
+        # coalesce consecutive writes (in index order) from the same relocated
+        # pc/lr to contiguous destinations into writerange rows
+        n = len(rows)
+        pc = rows['pc'].astype(numpy.int64)
+        dest = rows['dest'].astype(numpy.int64)
+        (pcs, inverse) = numpy.unique(pc, return_inverse=True)
+        size = numpy.array([writesizes.get(long(p), 0) for p in pcs],
+                           dtype=numpy.int64)[inverse]
+        segstart = numpy.ones(n, dtype=bool)
+        segstart[1:] = (rows['relocatedpc'][1:] != rows['relocatedpc'][:-1]) | \
+                       (rows['relocatedlr'][1:] != rows['relocatedlr'][:-1])
+        segid = numpy.cumsum(segstart) - 1
+        segfirst = numpy.flatnonzero(segstart)
+        segend = numpy.append(segfirst[1:], n)
+        # writes from a single pc that ascend continue a range when they are
+        # exactly size bytes after the previous write
+        runstart = segstart.copy()
+        runstart[1:] |= (dest[1:] - dest[:-1]) != size[1:]
+        irregular = numpy.zeros(len(segfirst), dtype=bool)
+        irregular[segid[(size < 0) | (pc != pc[segfirst][segid])]] = True
+
+        # segments with pushes or more than one pc are walked write by write,
+        # a push range only continues from the destlo of the last ascending range
+        ascending = numpy.where(runstart & ~irregular[segid], numpy.arange(n), -1)
+        ascending = numpy.maximum.accumulate(ascending)
+        lastascending = -1
+        for seg in numpy.flatnonzero(irregular):
+            (p, e) = (segfirst[seg], segend[seg])
+            prev = max(ascending[p - 1] if p > 0 else -1, lastascending)
+            destlo = dest[prev] if prev >= 0 else state['destlo']
+            for j in range(p, e):
+                if j > p and dest[j] == base + (j - r) * runsize:
+                    runstart[j] = False
+                    continue
+                runstart[j] = True
+                r = j
+                runsize = abs(size[j])
+                if size[j] >= 0:
+                    destlo = dest[j]
+                    lastascending = j
+                base = destlo
+        last = max(ascending[-1], lastascending)
+        if last >= 0:
+            state['destlo'] = dest[last]
+
+        starts = numpy.flatnonzero(runstart)
+        first = rows[starts]
+        numops = numpy.diff(numpy.append(starts, n))
+        push = size[starts] < 0
+        byteswritten = numops * numpy.abs(size[starts])
+        ranges = numpy.zeros(len(starts), dtype=self.histotable.dtype)
+        for f in ['pc', 'lr', 'relocatedpc', 'relocatedlr']:
+            ranges[f] = first[f]
+            ranges[f + 'lo'] = first[f] & 0xFFFFFFFF
+            ranges[f + 'hi'] = first[f] >> 32
+        ranges['cpsr'] = first['cpsr']
+        ranges['substage'] = first['substage']
+        ranges['index'] = numpy.arange(state['index'], state['index'] + len(starts))
+        state['index'] += len(starts)
+        ranges['numops'] = numops
+        ranges['byteswritten'] = byteswritten
+        d = dest[starts]
+        # a single push write ends up with destlo = desthi + size
+        destlo = numpy.where(push,
+                             numpy.where(numops == 1, d + numpy.abs(size[starts]), d - byteswritten),
+                             d)
+        desthi = numpy.where(push, d, d + byteswritten)
+        ranges['destlo'] = destlo
+        ranges['destlolo'] = destlo & 0xFFFFFFFF
+        ranges['destlohi'] = numpy.where(push, 0, d >> 32)
+        ranges['desthi'] = desthi
+        ranges['desthilo'] = desthi & 0xFFFFFFFF
+        ranges['desthihi'] = desthi >> 32
+        return ranges
+
     def index_write_table(self):
         self.h5file.flush()
 
     def add_write_entry(self, time, pid, size,
                         dest, pc, lr, cpsr,
                         callindex=0, substagenum=None):
-        #if self.pcmin > self.pcmax:
-        #    print "PC not in range %x %x (%x)" % (self.pcmin, self.pcmax, pc)
-            # traceback.print_stack()
-        #if (pc <= self.pcmax) and (pc >= self.pcmin):
-            # get relocation info from writesearch database
-        #index = self.trace_count
-        r = self.writestable.row
-        r['pid'] = pid
-        r['dest'] = dest
-        r['relocatedpc'] = pc
-        r['relocatedpclo'] = utils.addr_lo(pc)
-        r['relocatedpchi'] = utils.addr_hi(pc)
-        r['relocatedlr'] = lr
-        r['relocatedlrlo'] = utils.addr_lo(lr)
-        r['relocatedlrhi'] = utils.addr_hi(lr)
-        r['time'] = time
-        r['reportedsize'] = size
-        r['callindex'] = callindex
-        r['index'] = self.trace_count
-        r['cpsr'] = cpsr
-        r['pc'] = pc
-        r['pclo'] = utils.addr_lo(pc)
-        r['pchi'] = utils.addr_hi(pc)
-        r['lr'] = lr
-        r['lrlo'] = utils.addr_lo(lr)
-        r['lrhi'] = utils.addr_hi(lr)
-        if substagenum is not None:
-            r['substage'] = substagenum
-        for rinfo in self.rinfos:
-            offset = rinfo['reloffset']
-            start = (rinfo['startaddr']+offset)
-            end = start + rinfo['size'] + offset
-            # if pc is in a relocated dest range  (for now we assume no overlap)
-            if (start <= pc) and (pc <= end):
-                r['pc'] = pc - offset
-                r['pclo'] = utils.addr_lo(long(r['pc']))
-                r['pchi'] = utils.addr_hi(long(r['pc']))
-                r['lr'] = lr - offset
-                r['lrlo'] = utils.addr_lo(long(r['lr']))
-                r['lrhi'] = utils.addr_hi(long(r['lr']))
-                break
-        self.trace_count += 1
-        r.append()
+        self.add_write_entries({'time': [time], 'pid': [pid], 'size': [size],
+                                'dest': [dest], 'pc': [pc], 'lr': [lr], 'cpsr': [cpsr],
+                                'callindex': [callindex],
+                                'substage': [0 if substagenum is None else substagenum]})
+
+    def add_write_records(self, records, longwrites=None):
+        # a batch of write_record_dtype records and the longwrite_record_dtype
+        # records sent with them, into the writes, longwrites and write
+        # ranges tables
+        if longwrites is None:
+            longwrites = numpy.zeros(0, dtype=self.longwrite_record_dtype)
+        n = len(records)
+        if n + len(longwrites) == 0:
+            return
+        # longwrites take their place in the index sequence among the writes
+        before = longwrites['before']
+        first = self.trace_count
+        self.add_write_entries(dict({f: records[f] for f in records.dtype.names},
+                                    index=first + numpy.arange(n) +
+                                    numpy.searchsorted(before, numpy.arange(n), side='right')))
+        self.add_longwrite_entries(longwrites, first + before + numpy.arange(len(longwrites)))
+        self.trace_count = first + n + len(longwrites)
+        size = records['size']
+        lo = numpy.where(size < 0, records['dest'] + size, records['dest'])
+        hi = lo + numpy.abs(size)
+        lwhi = numpy.where(longwrites['inplace'], longwrites['start'] + longwrites['writesize'],
+                           longwrites['end'])
+        self.writerangetable.add_dsts_entries({
+            'lo': numpy.concatenate((lo, longwrites['start'])),
+            'hi': numpy.concatenate((hi, lwhi)),
+            'pc': numpy.concatenate((records['pc'], longwrites['pc'])),
+            'origpc': numpy.concatenate((records['origpc'], longwrites['origpc'])),
+            'substage': numpy.concatenate((records['substage'], longwrites['substage']))})
+
+    def add_longwrite_entries(self, longwrites, index):
+        if len(longwrites) == 0:
+            return
+        rows = numpy.zeros(len(longwrites), dtype=self.longwritestable.dtype)
+        for f in ['pid', 'stride', 'writesize', 'inplace', 'time', 'cpsr',
+                  'callindex', 'substage']:
+            rows[f] = longwrites[f]
+        rows['index'] = index
+        rows['numops'] = self.longwrite_numops(longwrites)
+        pc = longwrites['pc']
+        lr = longwrites['lr']
+        (origpc, origlr) = self._unrelocate(pc, lr)
+        for (name, values) in [('start', longwrites['start']), ('end', longwrites['end']),
+                               ('relocatedpc', pc), ('relocatedlr', lr),
+                               ('pc', origpc), ('lr', origlr)]:
+            values = values.astype(numpy.uint64)
+            rows[name] = values
+            rows[name + 'lo'] = values & 0xFFFFFFFF
+            rows[name + 'hi'] = values >> 32
+        self.longwritestable.append(rows)
+
+    @staticmethod
+    def longwrite_numops(longwrites):
+        # len(range(start, end, stride)) for each longwrite
+        span = longwrites['end'].astype(numpy.int64) - longwrites['start'].astype(numpy.int64)
+        stride = numpy.maximum(longwrites['stride'].astype(numpy.int64), 1)
+        return numpy.maximum((span + stride - 1) // stride, 0)
+
+    def expand_longwrites(self, longwrites):
+        # longwrites table rows as the writes table rows that one row per
+        # word would have been, each carrying its longwrite's index
+        numops = longwrites['numops'].astype(numpy.int64)
+        which = numpy.repeat(numpy.arange(len(longwrites)), numops)
+        word = numpy.arange(len(which)) - numpy.repeat(numpy.cumsum(numops) - numops, numops)
+        lw = longwrites[which]
+        rows = numpy.zeros(len(which), dtype=self.writestable.dtype)
+        for f in ['index', 'pid', 'time', 'cpsr', 'substage', 'callindex']:
+            rows[f] = lw[f]
+        for f in ['pc', 'lr', 'relocatedpc', 'relocatedlr']:
+            for suffix in ['', 'lo', 'hi']:
+                rows[f + suffix] = lw[f + suffix]
+        dest = lw['start'].astype(numpy.int64) + \
+            numpy.where(lw['inplace'], 0, word * lw['stride'])
+        dest = dest.astype(numpy.uint64)
+        rows['dest'] = dest
+        rows['destlo'] = dest & 0xFFFFFFFF
+        rows['desthi'] = dest >> 32
+        rows['reportedsize'] = lw['writesize']
+        return rows
+
+    def _unrelocate(self, pc, lr):
+        # if pc is in a relocated dest range, undo relocation
+        # (for now we assume no overlap)
+        pc = numpy.asarray(pc).astype(numpy.int64)
+        lr = numpy.asarray(lr).astype(numpy.int64)
+        (starts, ends, offsets) = self.relocbounds
+        if len(starts) > 0:
+            i = numpy.searchsorted(starts, pc, side='right') - 1
+            inrange = (i >= 0) & (pc <= ends[numpy.maximum(i, 0)])
+            offset = numpy.where(inrange, offsets[numpy.maximum(i, 0)], 0)
+            pc = pc - offset
+            lr = lr - offset
+        return (pc, lr)
+
+    def add_write_entries(self, columns):
+        # columns is a dict of equal-length arrays: 'time', 'pid', 'size', 'dest',
+        # 'pc', 'lr', 'cpsr' and optionally 'callindex', 'substage' and 'index'
+        n = len(columns['pc'])
+        if n == 0:
+            return
+        pc = numpy.asarray(columns['pc']).astype(numpy.int64)
+        lr = numpy.asarray(columns['lr']).astype(numpy.int64)
+        rows = numpy.zeros(n, dtype=self.writestable.dtype)
+
+        def setaddr(name, values):
+            values = values.astype(numpy.uint64)
+            rows[name] = values
+            rows[name + 'lo'] = values & 0xFFFFFFFF
+            rows[name + 'hi'] = values >> 32
+
+        rows['pid'] = numpy.asarray(columns['pid']).astype(numpy.int64)
+        rows['dest'] = numpy.asarray(columns['dest']).astype(numpy.int64)
+        rows['time'] = columns['time']
+        rows['reportedsize'] = columns['size']
+        rows['cpsr'] = numpy.asarray(columns['cpsr']).astype(numpy.int64)
+        if 'index' in columns:
+            rows['index'] = columns['index']
+        else:
+            rows['index'] = numpy.arange(self.trace_count, self.trace_count + n)
+        if 'callindex' in columns:
+            rows['callindex'] = columns['callindex']
+        if 'substage' in columns:
+            rows['substage'] = columns['substage']
+        setaddr('relocatedpc', pc)
+        setaddr('relocatedlr', lr)
+        (pc, lr) = self._unrelocate(pc, lr)
+        setaddr('pc', pc)
+        setaddr('lr', lr)
+        self.trace_count += n
+        self.writestable.append(rows)
@@ -22,6 +22,7 @@
 
 from config import Main
 import staticanalysis
+import ia
 import pytable_utils
 import addr_space
 import logging
@@ -32,6 +33,10 @@ import database
 import re
 import intervaltree
 import traceback
+import bisect
+import heapq
+import itertools
+import numpy
 import testsuite_utils as utils
 
 _singletons = {}
@@ -74,7 +79,7 @@ def create(*args, **kwargs):
     elif typ == "mmapdb":
         obj._mdb.create()
     elif typ == "tracedb":
-        obj._tdb._create()
+        obj._tdb._create(**kwargs)
     return obj
 
 
@@ -152,23 +157,36 @@ class MMapDB(DBObj):
 
 
 class StaticDB(DBObj):
+    # bumped whenever the tables may have been written to
+    version = 0
+    _writing = False
+
     def _open(self, append=False):
+        if append:
+            self.version += 1
+        self._writing = append
         self._db = staticanalysis.WriteSearch(False, self.stage, False, not append)
         self._db.open_all_tables()
         if self._db.writestable:
             logging.debug("opening staticdb nwrite %s" % (self._db.writestable.nrows))
 
     def _create(self):
+        self.version += 1
+        self._writing = True
         self._db = staticanalysis.WriteSearch(True, self.stage, False)
         self._db.setup_missing_tables()
 
     def _close(self):
+        if self._writing:
+            self.version += 1
         if self._db.writestable:
             logging.debug("closing staticdb nwrite %s" % (self._db.writestable.nrows))
         self._db.closedb(False)
 
     def flush(self):
         if self._db:
+            if self._writing:
+                self.version += 1
             self._db.closedb(True)
 
 
@@ -178,9 +196,9 @@ class TraceDB(DBObj):
         self._db = database.TraceTable(dbpath, self.stage, False, True)
         logging.debug("open tracedb nwrite %s (%s)" % (self._db.writestable.nrows, self.stage.stagename))
 
-    def _create(self):
+    def _create(self, bulk=False):
         dbpath = getattr(Main.raw.runtime.trace.db, self.stage.stagename)
-        self._db = database.TraceTable(dbpath, self.stage, True, True)
+        self._db = database.TraceTable(dbpath, self.stage, True, True, bulk)
 
     def _close(self):
         logging.debug("close tracedb nwrite %s (%s)" % (self._db.writestable.nrows, self.stage.stagename))
@@ -191,6 +209,57 @@ class TraceDB(DBObj):
             self._db.close(True)
 
 
+class AddrIndex():
+    # in-memory function and source lookups from a stage's staticdb
+    def __init__(self, sdb):
+        funcs = sorted((long(r['startaddr']), long(r['endaddr']), r['fname'])
+                       for r in sdb.funcstable.iterrows())
+        self.starts = [f[0] for f in funcs]
+        self.ends = [f[1] for f in funcs]
+        self.fnames = [f[2] for f in funcs]
+        self.srcs = {}
+        for r in sdb.srcstable.iterrows():
+            self.srcs.setdefault(long(r['addr']), (r['disasm'], r['src']))
+
+    def functionname(self, addr):
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0 and addr < self.ends[i]:
+            return self.fnames[i]
+        return ''
+
+    def disasm_and_src(self, pc):
+        return self.srcs[pc]
+
+
+class StaticWriteCache():
+    # static writes, skips and longwrites tables held in memory
+    def __init__(self, sdb, version):
+        self.version = version
+        fields = sdb.writestable.colnames
+        self.writes = {}
+        for r in sdb.writestable.iterrows():
+            self.writes.setdefault(long(r['pc']), []).append({f: r[f] for f in fields})
+        self.skips = {}
+        ranges = []
+        for r in sdb.skipstable.iterrows():
+            self.skips.setdefault(long(r['pc']), []).append({"resumepc": r["resumepc"],
+                                                             "thumb": r["thumb"]})
+            ranges.append((long(r['pc']), long(r['resumepc'])))
+        ranges.sort()
+        self.skipstarts = [start for (start, end) in ranges]
+        # furthest resumepc of any skip range starting at or before each start
+        self.skipreach = []
+        for (start, end) in ranges:
+            self.skipreach.append(max(end, self.skipreach[-1]) if self.skipreach else end)
+        self.longwrites = set(long(r['writeaddr']) for r in sdb.longwritestable.iterrows())
+        self.evaluators = None
+        self.instrs = None
+
+    def in_skip(self, pc):
+        i = bisect.bisect_right(self.skipstarts, pc)
+        return i > 0 and pc < self.skipreach[i - 1]
+
+
 class DBInfo():
     def __init__(self, *args, **kwargs):
         global _mmapdb
@@ -208,8 +277,13 @@ class DBInfo():
             self._sdb = StaticDB(self.stage)
             self._pdb = PolicyDB(self.stage)
             self._tdb = TraceDB(self.stage)
+        self._addrindex = None
+        self._writecache = None
+        self.write_cache_stats = {'loads': 0, 'hits': 0, 'misses': 0}
 
     def _closeall(self):
+        if self._writecache:
+            logging.info("static write cache %s: %s" % (self.key, self.write_cache_stats))
         for db in [self._mdb, self._sdb, self._pdb, self._tdb]:
             if db:
                 db.close()
@@ -258,6 +332,24 @@ class DBInfo():
         return [longwrites_dict(r)
                 for r in self._sdb.db.longwritestable.iterrows()]
 
+    def longwrite_candidates(self):
+        # hottest first, once a trace has been histogrammed
+        fields = self._sdb.db.longwritecandidatestable.colnames
+        rows = [{f: r[f] for f in fields}
+                for r in self._sdb.db.longwritecandidatestable.iterrows()]
+        return sorted(rows, key=lambda r: -r['writecount'])
+
+    def longwrite_blocks(self, breakaddr):
+        query = "(breakaddrlo == 0x%x) & (breakaddrhi == 0x%x)" % \
+            (utils.addr_lo(breakaddr), utils.addr_hi(breakaddr))
+        fields = self._sdb.db.longwriteblockstable.colnames
+        rows = [{f: r[f] for f in fields}
+                for r in self._sdb.db.longwriteblockstable.where(query)]
+        for r in rows:
+            # numpy drops trailing null bytes
+            r['ivalue'] = r['ivalue'].ljust(r['ilength'], b"\0")
+        return sorted(rows, key=lambda r: r['addr'])
+
     def smcs_info(self):
         fields = self._sdb.db.smcstable.colnames
         for r in self._sdb.db.smcstable.iterrows():
@@ -276,16 +368,21 @@ class DBInfo():
         return (rangetype == (staticanalysis.LongWriteRangeType.enum().sourcestrn)) \
             or (rangetype == (staticanalysis.LongWriteRangeType.enum().sourcestr))
 
-    def pc_writes_info(self, pc):
-        fields = ['pc', 'pclo', 'pchi', 'thumb', 'reg0', 'reg1', 'reg2',
-                  'reg3', 'reg4', 'writesize', 'halt']
+    def _static_writes(self):
+        if self._writecache is None or self._writecache.version != self._sdb.version:
+            self._writecache = StaticWriteCache(self._sdb.db, self._sdb.version)
+            self.write_cache_stats['loads'] += 1
+        return self._writecache
 
-        return {f: r[f] for f in fields
-                for r in
-                pytable_utils.query(self._sdb.db.writestable,
-                                    "(pclo == 0x%x) & (pchi == 0x%x)" %
-                                    (utils.addr_lo(pc),
-                                     utils.addr_hi(pc)))}
+    def _count(self, found):
+        self.write_cache_stats['hits' if found else 'misses'] += 1
+        return found
+
+    def pc_writes_info(self, pc):
+        rows = self._static_writes().writes.get(long(pc), [])
+        if self._count(rows):
+            return dict(rows[-1])
+        return {}
 
     def stage_exits(self):
         return [(r['addr'], r['line'], r['success'])
@@ -295,37 +392,24 @@ class DBInfo():
         return self._sdb.db.writestable.nrows
 
     def skip_pc(self, pc):
-        query = "(pclo <= 0x%x) & (pchi <= 0x%x) & " \
-            "(0x%x < resumepclo) & (0x%x <= resumepchi)" \
-            % (utils.addr_lo(pc), utils.addr_hi(pc),
-               utils.addr_lo(pc), utils.addr_hi(pc))
-        return pytable_utils.has_results(self._sdb.db.skipstable, query)
+        return self._count(self._static_writes().in_skip(long(pc)))
 
     def skip_info(self, pc):
-        query = "(pclo == 0x%x) & (pchi == 0x%x)" % \
-            (utils.addr_lo(pc),
-             utils.addr_hi(pc))
-
-        return [{"resumepc": r["resumepc"],
-                 "thumb": r["thumb"]}
-                for r in pytable_utils.query(self._sdb.db.skipstable, query)]
+        skips = self._static_writes().skips.get(long(pc), [])
+        self._count(skips)
+        return [dict(r) for r in skips]
 
     def is_pc_longwrite(self, pc):
-        query = "(0x%x == writeaddrlo) & (0x%x == writeaddrhi)" % \
-            (utils.addr_lo(pc),
-             utils.addr_hi(pc))
-        return pytable_utils.has_results(self._sdb.db.longwritestable, query)
+        return self._count(long(pc) in self._static_writes().longwrites)
 
     def write_info(self):
         return [(r['pc'], r['halt']) for r in self._sdb.db.writestable.iterrows()]
 
     def stepper_write_info(self, pc):
-        fields = self._sdb.db.writestable.colnames
-        query = "(pclo == 0x%x) & (pchi == 0x%x)" % \
-            (utils.addr_lo(pc),
-             utils.addr_hi(pc))
-        for r in pytable_utils.query(self._sdb.db.writestable, query):
-            yield {f: r[f] for f in fields}
+        rows = self._static_writes().writes.get(long(pc), [])
+        self._count(rows)
+        for r in rows:
+            yield dict(r)
 
     def src_write_info(self, pc):
         fields = self._sdb.db.srcstable.colnames
@@ -344,6 +428,12 @@ class DBInfo():
                                      lr, cpsr, callindex,
                                      substagenum)
 
+    def add_trace_write_entries(self, columns):
+        self._tdb.db.add_write_entries(columns)
+
+    def add_trace_write_records(self, records, longwrites=None):
+        self._tdb.db.add_write_records(records, longwrites)
+
     def callindex_to_fnname(self, idx):
         rs = pytable_utils.query(self._tdb.db.writestable,
                                  "callindex == %d" % idx)
@@ -355,9 +445,34 @@ class DBInfo():
         for r in pytable_utils.get_sorted(self._tdb.db.writestable, "callindex"):
             yield {f: r[f] for f in fields}
 
-    def trace_write_by_index(self):
+    def trace_write_by_index(self, expand_longwrites=False):
         fields = self._tdb.db.writestable.colnames
-        for r in pytable_utils.get_sorted(self._tdb.db.writestable, "index"):
+        writes = ({f: r[f] for f in fields}
+                  for r in pytable_utils.get_sorted(self._tdb.db.writestable, "index"))
+        if not expand_longwrites:
+            return writes
+        longwrites = self._tdb.db.longwritestable.read_sorted('index')
+        return self._merge_by_index(writes, self._expanded_longwrites(longwrites))
+
+    def _expanded_longwrites(self, longwrites):
+        rows = self._tdb.db.expand_longwrites(longwrites)
+        for r in rows:
+            yield {f: r[f] for f in rows.dtype.names}
+
+    @staticmethod
+    def _merge_by_index(*iters):
+        for (i, w) in heapq.merge(*[((w['index'], w) for w in it) for it in iters]):
+            yield w
+
+    def trace_longwrites(self, substage=None):
+        # longwrites table rows in trace order
+        table = self._tdb.db.longwritestable
+        fields = table.colnames
+        if substage is None:
+            rows = table.read_sorted('index')
+        else:
+            rows = numpy.sort(table.read_where("substage == %s" % substage), order='index')
+        for r in rows:
             yield {f: r[f] for f in fields}
 
     def trace_write_min_max(self):
@@ -388,21 +503,27 @@ class DBInfo():
     def update_trace_writes(self, line, pc, lo, hi, stage, origpc=None, substage=None):
         self._tdb.db.update_writes(line, pc, lo, hi, stage, origpc, substage)
 
-    def get_substage_writes(self, substage):
+    def get_substage_writes(self, substage, expand_longwrites=False):
         fields = self._tdb.db.writestable.colnames
         query = "substage == %s" % substage
-        for r in pytable_utils.query(self._tdb.db.writestable, query):
-            yield {f: r[f] for f in fields}
+        writes = ({f: r[f] for f in fields}
+                  for r in pytable_utils.query(self._tdb.db.writestable, query))
+        if not expand_longwrites:
+            return writes
+        longwrites = self._tdb.db.longwritestable.read_where(query)
+        return itertools.chain(writes, self._expanded_longwrites(longwrites))
 
 
     def trace_histogram(self):
         self._sdb._reopen(True)
         self._tdb.db.histogram()
+        self._sdb.db.rank_longwrite_candidates(self._tdb.db.histotable)
 
 
     def generate_write_range_file(self, out, out2):
         self._tdb._reopen(append=True)
         self._sdb._reopen(append=True)
+        self._addrindex = None
         # self._tdb.db.histogram()
         self._tdb.db.histograminfo(out, out2)
 
@@ -411,6 +532,8 @@ class DBInfo():
 
     def update_static_entries(self):
         self._sdb.db.update_from_trace(self._tdb.db.writestable)
+        self._writecache = None
+        self._addrindex = None
 
     def flush_tracedb(self):
         if self._tdb:
@@ -436,15 +559,39 @@ class DBInfo():
         return self._tdb.db.writerangetable_consolidated
 
     def pc_write_size(self, pc):
-        res = pytable_utils.query(self._sdb.db.writestable,
-                                  "(pclo == 0x%x) & (pchi == 0x%x)" %
-                                  (utils.addr_lo(pc),
-                                   utils.addr_hi(pc)))
-        try:
-            r = next(res)
-            return r['writesize']
-        except:
-            return 0
+        rows = self._static_writes().writes.get(long(pc), [])
+        if self._count(rows):
+            return rows[0]['writesize']
+        return 0
+
+    def write_evaluators(self):
+        # pc -> ia.StoreEvaluator for every static write, loaded once per stage
+        cache = self._static_writes()
+        if cache.evaluators is None:
+            cache.evaluators = {}
+            for (pc, rows) in cache.writes.iteritems():
+                r = rows[-1]  # last entry wins like pc_writes_info()
+                regs = [r['reg%d' % i] for i in range(4) if len(r['reg%d' % i]) > 0]
+                cache.evaluators[pc] = ia.StoreEvaluator(regs, int(r['lshift']), long(r['disp']),
+                                                         bool(r['subtracted']),
+                                                         int(r['writeback']), int(r['cc']),
+                                                         long(r['writesize']))
+        return cache.evaluators
+
+    def instr_values(self):
+        # pc -> instruction bytes for every pc in the srcs table
+        cache = self._static_writes()
+        if cache.instrs is None:
+            cache.instrs = {}
+            for r in self._sdb.db.srcstable.iterrows():
+                # numpy drops trailing null bytes
+                cache.instrs[long(r['addr'])] = r['ivalue'].ljust(r['ilength'], b"\0")
+        return cache.instrs
+
+    def pc_write_sizes(self):
+        # pc -> writesize, first entry wins like pc_write_size()
+        return {pc: rows[0]['writesize']
+                for (pc, rows) in self._static_writes().writes.iteritems()}
 
     def addr_in_srcs_table(self, pc):
         return pytable_utils.has_results(self._sdb.db.srcstable,
@@ -474,6 +621,11 @@ class DBInfo():
         else:
             return ''
 
+    def addr_index(self):
+        if self._addrindex is None:
+            self._addrindex = AddrIndex(self._sdb.db)
+        return self._addrindex
+
     def disasm_and_src_from_pc(self, pc):
         r = pytable_utils.query(self._sdb.db.srcstable, "(addrlo == 0x%x) & (addrhi == 0x%x)" %
                                 (utils.addr_lo(long(pc)), utils.addr_hi(long(pc))))
@@ -493,6 +645,7 @@ class DBInfo():
         r['disasm'] = disasm
         r.append()
         self._sdb.db.srcstable.flush()
+        self._addrindex = None
 
     def write_info_by_index(self):
         fields = self._sdb.db.writestable.colnames
@@ -515,7 +668,7 @@ class DBInfo():
             num = 0
             intervals = {n: intervaltree.IntervalTree() for n in substages}
 
-            for r in wt.read_sorted('index'):
+            for r in self._merge_by_index(self.trace_write_by_index(), self.trace_longwrites()):
                 pc = long(r['pc'])
                 if num < len(fns) - 1:
                     # check if we found the entrypoint to the next stage
@@ -523,11 +676,15 @@ class DBInfo():
                     if (lopc <= pc) and (pc < hipc):
                         num += 1
                 if num in substages:
-                    start = long(r['dest'])
-                    end = start + pytable_utils.get_rows(wt, '(pclo == %d) & (pchi == %d)' %
-                                                         utils.addr_lo(long(r['pc'])),
-                                                         utils.addr_hi(long(r['pc']))[0]['writesize'])
-                    intervals[num].add(intervaltree.Interval(start, end))
+                    if 'reportedsize' in r:
+                        start = long(r['dest'])
+                        end = start + long(r['reportedsize'])
+                        (start, end) = (min(start, end), max(start, end))
+                    else:  # a longwrite
+                        start = long(r['start'])
+                        end = start + long(r['writesize']) if r['inplace'] else long(r['end'])
+                    if start < end:
+                        intervals[num].add(intervaltree.Interval(start, end))
             return intervals
 
     def write_trace_intervals(self, interval, table):
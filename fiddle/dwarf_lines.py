@@ -0,0 +1,208 @@
+# MIT License
+
+# Copyright (c) 2017 Rebecca ".bx" Shapiro
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import os
+import subprocess
+
+_tables = {}
+_sources = {}
+
+
+class LineTable():
+    # address -> (file, line) from an ELF's decoded .debug_line program
+    def __init__(self, elf, cc=""):
+        cmd = "%sreadelf -W --debug-dump=decodedline %s 2>/dev/null" % (cc, elf)
+        try:
+            output = subprocess.check_output(cmd, shell=True)
+        except subprocess.CalledProcessError:
+            output = ""
+        rows = self._parse(output)
+        # end of sequence rows sort first so they never hide a row at the same address
+        rows.sort(key=lambda r: (r[0], r[2] is not None))
+        self.addrs = [r[0] for r in rows]
+        self.ends = [r[1] for r in rows]
+        self.paths = [r[2] for r in rows]
+        self.lines = [r[3] for r in rows]
+        self._ranges = None
+
+    @staticmethod
+    def _parse(output):
+        rows = []
+        path = ""
+        for l in output.split('\n'):
+            l = l.strip()
+            if l.endswith(':'):
+                path = l[4:-1] if l.startswith("CU: ") else l[:-1]
+                continue
+            cols = l.split()
+            if len(cols) < 3 or not cols[2].startswith("0x"):
+                continue
+            (name, line, addr) = cols[:3]
+            addr = long(addr, 16)
+            if line == '-':  # end of sequence
+                rows.append((addr, addr, None, 0))
+            elif line.isdigit():
+                if os.path.basename(path) == name:
+                    f = path
+                else:
+                    f = os.path.join(os.path.dirname(path), name)
+                rows.append((addr, addr, f, int(line)))
+        # each row covers addresses up to the next higher address of its
+        # sequence, several rows (location views) can share one address
+        (following, higher) = (None, None)
+        for i in reversed(range(len(rows))):
+            (addr, end, f, line) = rows[i]
+            if f is None:
+                (following, higher) = (addr, None)
+                continue
+            if following is not None and following > addr:
+                higher = following
+            if higher is not None:
+                rows[i] = (addr, higher, f, line)
+            following = addr
+        return rows
+
+    def lookup(self, addr):
+        i = bisect.bisect_right(self.addrs, addr) - 1
+        if i < 0 or self.paths[i] is None:
+            return None
+        return (self.paths[i], self.lines[i])
+
+    def _index(self):
+        # (file, line) -> lowest [start, end) and sorted lines with code per file
+        if self._ranges is None:
+            self._ranges = {}
+            for (start, end, path, line) in zip(self.addrs, self.ends, self.paths, self.lines):
+                if path is None or end <= start:  # covers no code
+                    continue
+                lines = self._ranges.setdefault(os.path.normpath(path), {})
+                if line not in lines or start < lines[line][0]:
+                    lines[line] = (start, end)
+            self._codelines = {f: sorted(lines.iterkeys())
+                               for (f, lines) in self._ranges.iteritems()}
+            self._basenames = {}
+            for f in self._ranges.iterkeys():
+                self._basenames.setdefault(os.path.basename(f), []).append(f)
+        return self._ranges
+
+    def files(self, filename):
+        # files in the line table that filename (a path suffix) refers to
+        self._index()
+        filename = os.path.normpath(filename)
+        return [f for f in self._basenames.get(os.path.basename(filename), [])
+                if f == filename or f.endswith("/" + filename) or
+                filename.endswith("/" + f)]
+
+    def line_range(self, filename, lineno):
+        # lowest [start, end) of lineno, None if it has no code
+        ranges = [self._index()[f][lineno] for f in self.files(filename)
+                  if lineno in self._ranges[f]]
+        return min(ranges) if ranges else None
+
+    def next_line_with_code(self, filename, lineno):
+        # first line at or after lineno with code, None if there is none
+        found = []
+        for f in self.files(filename):
+            lines = self._codelines[f]
+            i = bisect.bisect_left(lines, lineno)
+            if i < len(lines):
+                found.append(lines[i])
+        return min(found) if found else None
+
+    def _line_lookup(self, line):
+        # (start, end, has code) of "file:lineno" following gdb's "info line",
+        # None if the line table doesn't know the file
+        try:
+            (filename, lineno) = line.split(':')
+            lineno = int(lineno)
+        except ValueError:
+            return None
+        if not self.files(filename):
+            return None
+        r = self.line_range(filename, lineno)
+        if r is not None:
+            return (r[0], r[1], True)
+        if filename.endswith(".S"):
+            # a line without code in an assembly file is at the address of the next line with code
+            code = self.next_line_with_code(filename, lineno)
+            if code is not None:
+                addr = self.line_range(filename, code)[0]
+                return (addr, addr, False)
+        return (-1, -1, False)
+
+    def line_addr(self, line, start=True):
+        r = self._line_lookup(line)
+        if r is None:
+            return None
+        (lo, hi, code) = r
+        if lo < 0 or start:
+            return lo
+        return hi if code else lo + 1
+
+    def line_addrs(self, line):
+        r = self._line_lookup(line)
+        if r is None:
+            return None
+        (lo, hi, code) = r
+        if lo < 0 or code:
+            return (lo, hi)
+        return (lo, lo + 4)
+
+
+def get(elf, cc=""):
+    mtime = os.stat(elf).st_mtime
+    if elf not in _tables or _tables[elf][0] != mtime:
+        _tables[elf] = (mtime, LineTable(elf, cc))
+    return _tables[elf][1]
+
+
+def addr2line(addr, elf, cc="", srcdir=None):
+    res = get(elf, cc).lookup(addr)
+    if res is None:
+        return ""
+    (path, line) = res
+    if srcdir and not os.path.isabs(path):
+        path = os.path.join(srcdir, path)
+    return "%s:%d" % (os.path.normpath(path), line)
+
+
+def source_line(path, lineno):
+    if path not in _sources:
+        try:
+            with open(path, "r") as f:
+                _sources[path] = f.read().split('\n')
+        except IOError:
+            _sources[path] = []
+    lines = _sources[path]
+    if 0 < lineno <= len(lines):
+        return lines[lineno - 1].strip()
+    return ""
+
+
+def line2src(line):
+    try:
+        [path, lineno] = line.split(':')
+        lineno = int(lineno)
+    except ValueError:
+        return ""
+    return source_line(path, lineno)
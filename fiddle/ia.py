@@ -8,6 +8,8 @@ import re
 class InstructionAnalyzer():
     WORD_SIZE = 4
     writemnere = re.compile("(push)|(stm)|(str)|(stl)|(stc)")
+    branchmnere = re.compile("^(b|cbz|cbnz)(eq|ne|hs|cs|lo|cc|mi|pl|vs|vc|hi|ls|ge|lt|gt|le|al)?(\.w|\.n)?$")
+    callmnes = ['bl', 'blx', 'bx', 'svc', 'smc']
 
     def __init__(self):
         self.thumb = Cs(CS_ARCH_ARM, CS_MODE_THUMB)
@@ -21,7 +23,7 @@ class InstructionAnalyzer():
     def disasm(self, value, thumb, pc, cache=False):
         offset = pc
         ins = None
-        if cache and pc in self.cache.iterkeys():
+        if cache and pc in self.cache:
             return self.cache[pc]
         if thumb:
             ins = self.thumb.disasm(value, offset, count=1)
@@ -40,63 +42,38 @@ class InstructionAnalyzer():
     def is_instr_memstore(self, ins):
         return self.is_mne_memstore(ins.mnemonic)
 
-    def get_flag_value(self, flag, cpsr):
+    @classmethod
+    def get_flag_value(cls, flag, cpsr):
         flags = {'n': (1 << 31), 'z': (1 << 30), 'c': (1 << 29), 'v': (1 << 28), 'q': (1 << 27)}
         return True if ((cpsr & flags[flag]) == flags[flag]) else False
 
+    @classmethod
+    def condition_holds(cls, cc, cpsr):
+        # cc is capstone's ARM_CC_*
+        n = cls.get_flag_value('n', cpsr)
+        z = cls.get_flag_value('z', cpsr)
+        c = cls.get_flag_value('c', cpsr)
+        v = cls.get_flag_value('v', cpsr)
+        conds = {ARM_CC_EQ: z,
+                 ARM_CC_NE: not z,
+                 ARM_CC_HS: c,
+                 ARM_CC_LO: not c,
+                 ARM_CC_MI: n,
+                 ARM_CC_PL: not n,
+                 ARM_CC_VS: v,
+                 ARM_CC_VC: not v,
+                 ARM_CC_HI: c and not z,
+                 ARM_CC_LS: (not c) or z,
+                 ARM_CC_GE: n == v,
+                 ARM_CC_LT: not n == v,
+                 ARM_CC_GT: (not z) and n == v,
+                 ARM_CC_LE: z or not n == v}
+        return conds.get(cc, True)
+
     # inclase there is a conditional store check
     def store_will_happen(self, ins, regs):
         if self.has_condition_suffix(ins):
-            cc = ins.cc
-            cpsr = regs[-1]
-            if cc == 0:
-                # eq
-                return self.get_flag_value('z', cpsr) is True
-            elif cc == 1:
-                # not equal, ne
-                return self.get_flag_value('z', cpsr) is False
-            elif cc == 2:
-                # carry set, hs
-                return self.get_flag_value('c', cpsr) is True
-            elif cc == 3:
-                # lo, cary clear
-                return self.get_flag_value('c', cpsr) is False
-            elif cc == 4:
-                # mi,
-                return self.get_flag_value('n', cpsr) is True
-            elif cc == 5:
-                # pl
-                return self.get_flag_value('n', cpsr) is False
-            elif cc == 6:
-                # vs
-                return self.get_flag_value('v', cpsr) is True
-            elif cc == 7:
-                return self.get_flag_value('v', cpsr) is False
-                # vc
-            elif cc == 8:
-                # hi
-                return (self.get_flag_value('c', cpsr) is True) \
-                    and (self.get_flag_value('z', cpsr) is False)
-            elif cc == 9:
-                # ls
-                return (self.get_flag_value('c', cpsr) is False) \
-                    or (self.get_flag_value('z', cpsr) is True)
-            elif cc == 10:
-                # ge
-                return (self.get_flag_value('n', cpsr) == self.get_flag_value('v', cpsr))
-            elif cc == 11:
-                # lt
-                return not (self.get_flag_value('n', cpsr) == self.get_flag_value('v', cpsr))
-            elif cc == 12:
-                # gt
-                return (self.get_flag_value('z', cpsr) is False) \
-                    and (self.get_flag_value('n', cpsr) == self.get_flag_value('v', cpsr))
-            elif cc == 13:
-                # le
-                return (self.get_flag_value('z', cpsr) is True) \
-                    or (not (self.get_flag_value('n', cpsr) == self.get_flag_value('v', cpsr)))
-            else:
-                return True
+            return self.condition_holds(ins.cc, regs[-1])
         else:
             return True
 
@@ -105,20 +82,9 @@ class InstructionAnalyzer():
         return True if (cpsr & CPSR_THUMB) == CPSR_THUMB else False  # if cpsr bit 5 is set
 
     def calculate_store_offset(self, ins, regs):
-        if self.has_condition_suffix(ins):
-            # strip off cpsr
-            regs = regs[:-1]
-        operands = ins.operands
-        lshift = 0
-        disp = 0
-        for i in operands:
-            if i.type == ARM_OP_MEM:
-                lshift = i.mem.lshift
-                disp = i.mem.disp
-        if lshift > 0:
-            regs[1] = (regs[1] << lshift) % (0xFFFFFFFF)
-
-        return (sum(regs) + disp) % (0xFFFFFFFF)
+        f = self.store_evaluator(ins)
+        return StoreEvaluator([], f['lshift'], f['disp'], f['subtracted'], f['writeback'],
+                              f['cc'], 0).destination(regs)
 
     @classmethod
     def has_condition_suffix(cls, ins):
@@ -204,9 +170,151 @@ class InstructionAnalyzer():
             regs.append('cpsr')
         return regs
 
+    @classmethod
+    def branch_target(cls, mne, op_str):
+        # (target, conditional) of a direct branch, None for anything else
+        m = cls.branchmnere.match(mne)
+        if not m:
+            return None
+        try:
+            target = long(op_str.split("#")[-1], 0)
+        except ValueError:
+            return None
+        return (target, m.group(1) != 'b' or m.group(2) not in [None, 'al'])
+
+    @classmethod
+    def leaves_function(cls, mne, op_str):
+        # calls, returns and anything else that writes pc
+        if mne.split('.')[0] in cls.callmnes:
+            return True
+        if op_str.split(',')[0].strip() == 'pc':
+            return True
+        return (mne.startswith('pop') or mne.startswith('ldm')) and 'pc' in op_str
+
+    @classmethod
+    def store_base(cls, ins):
+        if ins.mnemonic.startswith("stm"):
+            return ins.operands[0].reg
+        for i in ins.operands:
+            if i.type == ARM_OP_MEM:
+                return i.mem.base
+        return 0
+
+    @classmethod
+    def _writeback_stride(cls, ins):
+        if ins.mnemonic.startswith("stm"):
+            size = cls.calculate_store_size(ins)
+            return -size if ins.mnemonic.startswith("stmd") else size
+        for i in ins.operands[2:]:
+            if i.type == ARM_OP_IMM:
+                return -i.imm if i.subtracted else i.imm
+        for i in ins.operands:
+            if i.type == ARM_OP_MEM:
+                return i.mem.disp
+        return None
+
+    @classmethod
+    def store_stride(cls, ins, body):
+        # how far the store's base register moves each time around the
+        # loop made of the instructions in body (0 if it stays put), None
+        # if the base is changed in a way that isn't worked out here
+        base = cls.store_base(ins)
+        stride = 0
+        for i in body:
+            ops = i.operands
+            if i.address == ins.address:
+                if ins.writeback:
+                    step = cls._writeback_stride(ins)
+                    if step is None:
+                        return None
+                    stride += step
+                continue
+            if i.writeback:
+                moved = ops[0].reg if i.mnemonic[:3] in ("ldm", "stm") else cls.store_base(i)
+                if moved == base:
+                    return None
+            if not (ops and ops[0].type == ARM_OP_REG and ops[0].reg == base) or \
+               cls._is_mne_memstore(i.mnemonic) or \
+               i.mnemonic[:3] in ("cmp", "cmn", "tst", "teq"):
+                continue
+            # the base register is written
+            if not (i.mnemonic.startswith("add") or i.mnemonic.startswith("sub")):
+                return None
+            if len(ops) == 3 and ops[1].type == ARM_OP_REG and ops[1].reg == base:
+                ops = [ops[0], ops[2]]
+            if not (len(ops) == 2 and ops[1].type == ARM_OP_IMM):
+                return None
+            stride += -ops[1].imm if i.mnemonic.startswith("sub") else ops[1].imm
+        return stride
+
+    @classmethod
+    def store_evaluator(cls, ins):
+        # everything besides register values needed to work out where a
+        # store writes, so it can be done without disassembling at runtime
+        fields = {'lshift': 0,
+                  'disp': 0,
+                  'subtracted': False,
+                  'writeback': StoreEvaluator.NOWRITEBACK,
+                  'cc': ins.cc}
+        ops = ins.operands
+        for (n, i) in enumerate(ops):
+            if i.type == ARM_OP_MEM:
+                fields['lshift'] = i.mem.lshift
+                fields['disp'] = i.mem.disp
+                fields['subtracted'] = bool(i.subtracted)
+                if ins.writeback:
+                    # an offset after the brackets is applied after the store
+                    post = len(ops) > n + 1
+                    fields['writeback'] = StoreEvaluator.POSTINDEX if post \
+                        else StoreEvaluator.PREINDEX
+        return fields
+
     @classmethod
     def _is_mne_memstore(cls, mne):
         return InstructionAnalyzer.writemnere.match(mne) is not None
 
     def is_mne_memstore(self, mne):
         return self._is_mne_memstore(mne)
+
+
+class StoreEvaluator():
+    # a store's destination as a function of the registers it reads
+    NOWRITEBACK = 0
+    PREINDEX = 1
+    POSTINDEX = 2
+
+    def __init__(self, regs, lshift, disp, subtracted, writeback, cc, size):
+        self.regs = regs  # registers to read, cpsr last if conditional
+        self.lshift = lshift
+        self.disp = disp
+        self.subtracted = subtracted
+        self.writeback = writeback
+        self.cc = cc
+        self.size = size
+
+    def conditional(self):
+        return self.cc not in [ARM_CC_AL, ARM_CC_INVALID]
+
+    def will_happen(self, values):
+        # a conditional store's cpsr is the last value
+        if self.conditional():
+            return InstructionAnalyzer.condition_holds(self.cc, values[-1])
+        return True
+
+    def destination(self, values):
+        if self.conditional():
+            values = values[:-1]
+        dst = values[0] if values else 0
+        if len(values) > 1:
+            index = values[1] << self.lshift
+            dst = dst - index if self.subtracted else dst + index
+        if self.writeback != self.POSTINDEX:
+            dst += self.disp
+        return dst & 0xFFFFFFFF
+
+    def __call__(self, values):
+        # (start, end) written given the values of self.regs
+        dst = self.destination(values)
+        if self.size < 0:  # (ie. push instruction)
+            return (dst + self.size, dst)
+        return (dst, dst + self.size)
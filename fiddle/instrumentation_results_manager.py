@@ -54,6 +54,7 @@ from doit.tools import LongRunning, Interactive, PythonInteractiveAction
 import inspect
 import string
 import pure_utils
+import staticdb_cache
 import external_source_manager
 from doit.tools import create_folder
 import tempfile
@@ -1346,13 +1347,19 @@ class InstrumentationTaskLoader(ResultsLoader):
                     done_target = Main.get_static_analysis_config("db_done",
                                                                   self.stage)
                     target = Main.get_static_analysis_config("db", self.stage)
-                    if not os.path.exists(done_target):
+                    if not (os.path.exists(done_target) and WS.schema_current(target)):
                         if os.path.exists(target):
                             # if done doesnt existb but target does,
                             # probably means
-                            # target db was not sucessfully created
+                            # target db was not sucessfully created,
+                            # or it has an older table layout
                             os.remove(target)
-                        db_info.create(self.stage, "staticdb")
+                        cache = staticdb_cache.StaticDBCache()
+                        key = staticdb_cache.stage_key(self.stage)
+                        if not cache.fetch(key, target):
+                            db_info.create(self.stage, "staticdb")
+                            db_info.get(self.stage).flush_staticdb()
+                            cache.store(key, target, self.stage)
                     return os.system("touch %s" % done_target) == 0
             n = s.stagename
             target = Main.get_static_analysis_config("db", s)
@@ -1363,6 +1370,8 @@ class InstrumentationTaskLoader(ResultsLoader):
                                    [s.elf],
                                    [target, done_target],
                                    "staticanalysis_%s" % n)
+            if os.path.exists(done_target) and not WS.schema_current(target):
+                rtask.other.update({'uptodate': [False]})
             tasks.append(rtask)
         return tasks
 
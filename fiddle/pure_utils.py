@@ -23,9 +23,195 @@
 import hashlib
 import run_cmd
 import re
+import os
+import bisect
+import struct
 import r2_keeper as r2
 shell = run_cmd.Cmd()
 
+EM_ARM = 40
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+STT_FUNC = 2
+STT_SECTION = 3
+STT_FILE = 4
+
+_elf_infos = {}
+
+
+class ElfInfo():
+    # symbols, sections and ARM mapping symbol ranges of an ELF, read
+    # straight from its headers once instead of asking nm, readelf or r2
+    def __init__(self, elf):
+        with open(elf, "rb") as f:
+            data = f.read()
+        if data[:4] != "\x7fELF":
+            raise Exception("%s is not an ELF file" % elf)
+        end = "<" if ord(data[5]) == 1 else ">"
+        if ord(data[4]) == 2:
+            (shoff,) = struct.unpack_from(end + "Q", data, 0x28)
+            (shentsize, shnum, shstrndx) = struct.unpack_from(end + "HHH", data, 0x3a)
+            shfmt = end + "IIQQQQIIQQ"
+            symfmt = end + "IBBHQQ"
+            symfields = ("name", "info", "other", "shndx", "value", "size")
+        else:
+            (shoff,) = struct.unpack_from(end + "I", data, 0x20)
+            (shentsize, shnum, shstrndx) = struct.unpack_from(end + "HHH", data, 0x2e)
+            shfmt = end + "IIIIIIIIII"
+            symfmt = end + "IIIBBH"
+            symfields = ("name", "value", "size", "info", "other", "shndx")
+        (self.machine,) = struct.unpack_from(end + "H", data, 0x12)
+        symsize = struct.calcsize(symfmt)
+
+        raw = [dict(zip(("name", "type", "flags", "addr", "offset", "size",
+                         "link", "info", "addralign", "entsize"),
+                        struct.unpack_from(shfmt, data, shoff + i * shentsize)))
+               for i in range(shnum)]
+
+        def string(section, offset):
+            start = raw[section]['offset'] + offset
+            return data[start:data.index("\0", start)]
+
+        # same layout as r2's iSj, as returned by get_section_headers
+        self.sections = []
+        for (i, h) in enumerate(raw):
+            f = h['flags']
+            self.sections.append({
+                "number": i,
+                "name": string(shstrndx, h['name']) if shnum > shstrndx else "",
+                "address": h['addr'],
+                "offset": h['offset'],
+                "size": h['size'],
+                "filesize": 0 if h['type'] == SHT_NOBITS else h['size'],
+                "flags": "-%s%s%s" % ("r" if f & SHF_ALLOC else "-",
+                                      "w" if f & SHF_WRITE else "-",
+                                      "x" if f & SHF_EXECINSTR else "-")
+            })
+
+        # symbols in the order readelf -s lists them
+        self.symbols = []
+        for h in raw:
+            if h['type'] not in (SHT_SYMTAB, SHT_DYNSYM):
+                continue
+            for i in range(h['size'] / symsize):
+                sym = dict(zip(symfields, struct.unpack_from(symfmt, data,
+                                                             h['offset'] + i * symsize)))
+                sym['name'] = string(h['link'], sym['name'])
+                sym['type'] = sym['info'] & 0xf
+                sym['symtab'] = h['type'] == SHT_SYMTAB
+                # r2 reports thumb functions without their lowest bit set
+                sym['vaddr'] = sym['value']
+                if self.machine == EM_ARM and sym['type'] == STT_FUNC:
+                    sym['vaddr'] &= ~1
+                self.symbols.append(sym)
+
+        self.byname = {}
+        for sym in sorted((s for s in self.symbols if s['shndx'] != 0 and s['name']),
+                          key=lambda s: not s['symtab']):
+            self.byname.setdefault(sym['name'], sym)
+        # defined symbols with a size, as listed by nm -S -n
+        self.sized = sorted(((s['value'], s['size'], s['name']) for s in self.symbols
+                             if s['symtab'] and s['shndx'] != 0 and s['size'] > 0 and
+                             s['type'] not in (STT_SECTION, STT_FILE)),
+                            key=lambda s: (s[0], s[2]))
+        self.functions = sorted((s['vaddr'], s['vaddr'] + s['size'], s['name'])
+                                for s in self.symbols
+                                if s['symtab'] and s['type'] == STT_FUNC and
+                                s['shndx'] != 0 and s['size'] > 0)
+        self.function_starts = [f[0] for f in self.functions]
+        self.longest_function = max([f[1] - f[0] for f in self.functions] or [0])
+        self.c_functions = [(s['name'], s['value']) for s in self.symbols
+                            if s['type'] == STT_FUNC and s['name']]
+
+        # ranges between consecutive $t/$a/$d mapping symbols
+        self.mapping = {'t': [], 'a': [], 'd': []}
+        prev = None
+        lo = 0
+        for (addr, name) in sorted((s['value'] & 0xffffffff, s['name']) for s in self.symbols
+                                   if s['symtab'] and s['name'] in ("$t", "$a", "$d")):
+            if (prev is not None) and (not lo == addr):
+                self.mapping[prev].append((lo, addr))
+            lo = addr
+            prev = name[1]
+
+    def section(self, name):
+        for h in self.sections:
+            if h['name'] == name:
+                return h
+        return None
+
+    def function_at(self, addr):
+        # (start, end, name) of the closest preceding function covering addr
+        i = bisect.bisect_right(self.function_starts, addr) - 1
+        while i >= 0 and self.functions[i][0] > addr - self.longest_function:
+            if addr < self.functions[i][1]:
+                return self.functions[i]
+            i -= 1
+        return None
+
+
+def elf_info(elf):
+    mtime = os.stat(elf).st_mtime
+    if elf not in _elf_infos or _elf_infos[elf][0] != mtime:
+        _elf_infos[elf] = (mtime, ElfInfo(elf))
+    return _elf_infos[elf][1]
+
+
+class CoreStates():
+    # arm or thumb core state at a pc, from sorted arm ranges. Answers are
+    # memoized per pc, and runtime addresses of relocated code are looked up
+    # at the address they were linked at
+    def __init__(self, elf, armranges, thumbfns=None):
+        if thumbfns is None:
+            thumbfns = ["clear_bss"]
+        armranges = sorted(armranges)
+        self.starts = [r[0] for r in armranges]
+        self.ends = [r[1] for r in armranges]
+        info = elf_info(elf)
+        # hack, functions that run in thumb whatever their mapping says
+        self.thumbfns = []
+        for name in thumbfns:
+            sym = info.byname.get(name)
+            if sym is None:
+                continue
+            lo = sym['vaddr'] & ~1
+            hi = lo + sym['size']
+            if not sym['size']:
+                # no .size, assume it runs up to the next function
+                i = bisect.bisect_right(info.function_starts, lo)
+                hi = info.function_starts[i] if i < len(info.function_starts) else lo + 1
+            self.thumbfns.append((lo, hi))
+        self.relocations = []
+        self.cache = {}
+
+    def relocate(self, start, size, offset, mod):
+        lo = (start + offset) % mod
+        self.relocations.append((lo, lo + size, offset, mod))
+        self.cache = {}
+
+    def __call__(self, addr):
+        typ = self.cache.get(addr)
+        if typ is not None:
+            return typ
+        orig = addr
+        for (lo, hi, offset, mod) in reversed(self.relocations):
+            if lo <= addr < hi:
+                orig = (addr - offset) % mod
+                break
+        i = bisect.bisect_right(self.starts, orig) - 1
+        if any(lo <= orig < hi for (lo, hi) in self.thumbfns):
+            typ = "thumb"
+        elif i >= 0 and orig < self.ends[i]:
+            typ = "arm"
+        else:
+            typ = "thumb"
+        self.cache[addr] = typ
+        return typ
+
 
 def file_md5(filename):
     m = hashlib.md5()
@@ -44,18 +230,7 @@ def get_entrypoint(elf):
 
 
 def get_c_function_names(elf, cc="/usr/bin/"):
-    cmd = '%sreadelf -W -s %s | grep FUNC 2>/dev/null' % (cc, elf)
-    output = shell.run_multiline_cmd(cmd)
-
-    results = []
-    for l in output:
-        cols = l.split()
-        if len(cols) > 7:
-            addr = cols[1]
-            name = cols[7]
-            results.append((name, long(addr, 16)))
-
-    return results
+    return list(elf_info(elf).c_functions)
 
 
 def get_image_size(image):
@@ -83,52 +258,26 @@ def get_min_max_pcs(elf):
     return (lo, hi)
 
 def get_section_headers(elf):
-    ds = r2.get(elf, "iSj")
-    index = 0
-    headers = []
-    if len(ds) > 0:
-        # flags key differs between r2 versions
-        if "flags" in ds[0]:
-            flags = "flags"
-        else:
-            flags = "perm"
-    for d in ds:
-        h = {
-            "number": index,
-            "name": d["name"],
-            "address": d["vaddr"],
-            "offset": d["paddr"],
-            "size": d['vsize'],
-            "filesize": d['size'],
-            "flags": d[flags]
-        }
-        headers.append(h)
-        index += 1
-    return headers
+    return [dict(h) for h in elf_info(elf).sections]
 
 
 def get_section_location(elf, name):
-    start = 0
-    end = 0
+    h = elf_info(elf).section(name)
+    if h is None:
+        return (-1, -1)
+    return (h['address'], h['address'] + h['size'])
 
-    headers = get_section_headers(elf)
-    for h in headers:
-        if h['name'] == name:
-            start = h['address']
-            end = start+h['size']
-            return (start, end)
-    return (-1, -1)
+
+def get_symbol_info(elf, name, debug=False):
+    i = elf_info(elf).byname.get(name)
+    if debug and i:
+        print i
+    return i
 
 
 def get_symbol_location(elf, name, debug=False):
-    s = r2.get(elf, "isj")
-    name = u"%s" % name # convert to unicode
-    for i in s:
-        if i["name"] == name:
-            if debug:
-                print i
-            return i["vaddr"]
-    return -1
+    i = get_symbol_info(elf, name, debug)
+    return i['vaddr'] if i else -1
 
 
 def addr2functionname(addr, elf, debug=False):
@@ -10,6 +10,7 @@ import struct
 import inspect
 import sys
 import os
+import numpy
 from config import Main
 qemu = Main.object_config_lookup("Software", "qemu")
 sys.path.append(os.path.join(qemu.root, "scripts"))
@@ -30,6 +31,17 @@ dropped_event_id = 0xfffffffffffffffe
 
 log_header_fmt = '=QQQ'
 rec_header_fmt = '=QQII'
+rec_header_fields = [('event_id', '=u8'), ('timestamp', '=u8'),
+                     ('record_length', '=u4'), ('record_pid', '=u4')]
+
+# number of bytes read from the trace file at a time by read_trace_chunks
+chunk_size = 1 << 24
+# records first looked at for the end of a run of one event, doubled while
+# the run keeps going, so short runs of interleaved events stay cheap
+run_window = 64
+
+# write record columns pulled out of a chunk by record_columns
+write_columns = ['timestamp', 'pid', 'size', 'addr', 'pc', 'lr', 'cpsr']
 
 
 def read_header(fobj, hfmt):
@@ -99,6 +111,113 @@ def read_trace_records(edict, fobj):
         yield rec
 
 
+def event_dtype(event):
+    """NumPy record dtype of a fixed-width event, or None if the
+ event has string arguments (and so no fixed record size)."""
+    fields = list(rec_header_fields)
+    for type, name in event.args:
+        if is_string(type):
+            return None
+        fields.append(('arg_%s' % name, '=u8'))
+    return numpy.dtype(fields)
+
+
+def get_buffered_record(edict, buf, offset):
+    """Deserialize a single trace record starting at offset in buf.
+ Returns (record tuple, offset of next record), or None if buf
+ does not hold the whole record."""
+    hlen = struct.calcsize(rec_header_fmt)
+    if len(buf) - offset < hlen:
+        return None
+    rechdr = struct.unpack_from(rec_header_fmt, buf, offset)
+    offset += hlen
+    rec = (rechdr[0], rechdr[1], rechdr[3])
+    for type, name in edict[rechdr[0]].args:
+        if is_string(type):
+            if len(buf) - offset < 4:
+                return None
+            (l,) = struct.unpack_from('=L', buf, offset)
+            offset += 4
+            if len(buf) - offset < l:
+                return None
+            rec = rec + (buf[offset:offset + l],)
+            offset += l
+        else:
+            if len(buf) - offset < 8:
+                return None
+            (value,) = struct.unpack_from('=Q', buf, offset)
+            offset += 8
+            rec = rec + (value,)
+    return (rec, offset)
+
+
+def read_trace_chunks(edict, dtypes, fobj):
+    """Deserialize trace records from a file in large chunks.
+
+ Yields (event_num, records) where records is a NumPy record array
+ (see event_dtype) holding a run of consecutive records of the same
+ fixed-width event, or a single record tuple (as read_trace_records
+ yields) for events with string arguments."""
+    hlen = struct.calcsize(rec_header_fmt)
+    buf = b""
+    done = False
+    while not done:
+        data = fobj.read(chunk_size)
+        done = len(data) == 0
+        buf = buf + data
+        offset = 0
+        while len(buf) - offset >= hlen:
+            (event_num,) = struct.unpack_from('=Q', buf, offset)
+            dtype = dtypes[event_num]
+            if dtype is None:
+                res = get_buffered_record(edict, buf, offset)
+                if res is None:
+                    break
+                (rec, offset) = res
+                yield (event_num, rec)
+                continue
+            count = (len(buf) - offset) / dtype.itemsize
+            if count == 0:
+                break
+            # the run ends at the first record with another event id
+            n = 0
+            window = run_window
+            while n < count:
+                step = min(window, count - n)
+                ids = numpy.frombuffer(buf, dtype=dtype, count=step,
+                                       offset=offset + n * dtype.itemsize)['event_id']
+                others = numpy.flatnonzero(ids != event_num)
+                if len(others) > 0:
+                    n += int(others[0])
+                    break
+                n += step
+                window *= 2
+            yield (event_num, numpy.frombuffer(buf, dtype=dtype, count=n, offset=offset))
+            offset += n * dtype.itemsize
+        buf = buf[offset:]
+    if len(buf) > 0:
+        sys.stderr.write("ignoring %d bytes of truncated trace record\n" % len(buf))
+
+
+def record_tuples(recs):
+    """Convert a record array from read_trace_chunks to record tuples"""
+    for r in recs.tolist():
+        yield (r[0], r[1], r[3]) + r[4:]
+
+
+def record_columns(event, recs):
+    """Pull the write_columns out of a record array as int64 columns,
+ filling in -1 for any argument the event does not have."""
+    names = [n for (t, n) in event.args]
+    cols = {'timestamp': recs['timestamp']}
+    for c in write_columns[1:]:
+        if c in names:
+            cols[c] = recs['arg_%s' % c].astype(numpy.int64)
+        else:
+            cols[c] = numpy.full(len(recs), -1, dtype=numpy.int64)
+    return cols
+
+
 class Analyzer(object):
     """A trace file analyzer which processes trace records.
 
@@ -117,6 +236,11 @@ class Analyzer(object):
         """Called if no specific method for processing a trace event has been found."""
         pass
 
+    def catchall_chunk(self, event, recs, db):
+        """Called with a record array of fixed-width events that have no specific method."""
+        for rec in record_tuples(recs):
+            self.catchall(event, rec, db)
+
     def end(self):
         """Called at the end of the trace."""
         pass
@@ -155,6 +279,19 @@ class Formatter(Analyzer):
             i = i+1
         db_info.get(stage).add_trace_write_entry(timestamp, pid, size, addr, pc, lr, cpsr)
 
+    def catchall_chunk(self, event, recs, stage):
+        if len(recs) == 0:
+            return
+        cols = record_columns(event, recs)
+        self.last_timestamp = cols['timestamp'][-1]
+        db_info.get(stage).add_trace_write_entries({'time': cols['timestamp'],
+                                                    'pid': cols['pid'],
+                                                    'size': cols['size'],
+                                                    'dest': cols['addr'],
+                                                    'pc': cols['pc'],
+                                                    'lr': cols['lr'],
+                                                    'cpsr': cols['cpsr']})
+
 
 def process(events, log, analyzer, read_header, stage):
 
@@ -172,6 +309,7 @@ def process(events, log, analyzer, read_header, stage):
 
     for num, event in enumerate(events):
         edict[num] = event
+    dtypes = {num: event_dtype(event) for (num, event) in edict.iteritems()}
 
     def build_fn(analyzer, event):
         if isinstance(event, str):
@@ -195,13 +333,19 @@ def process(events, log, analyzer, read_header, stage):
 
     analyzer.begin()
     fn_cache = {}
-    db_info.create(stage, "tracedb")
-    for rec in read_trace_records(edict, log):
-        event_num = rec[0]
+    db_info.create(stage, "tracedb", bulk=True)
+    for (event_num, recs) in read_trace_chunks(edict, dtypes, log):
         event = edict[event_num]
         if event_num not in fn_cache:
             fn_cache[event_num] = build_fn(analyzer, event)
-        fn_cache[event_num](event, rec, stage)
+        fn = fn_cache[event_num]
+        if isinstance(recs, tuple):
+            fn(event, recs, stage)
+        elif getattr(analyzer, event.name, None) is None:
+            analyzer.catchall_chunk(event, recs, stage)
+        else:
+            for rec in record_tuples(recs):
+                fn(event, rec, stage)
     db_info.get(stage).flush_tracedb()
 
 
@@ -1,25 +1,274 @@
 import r2pipe
 import json
+import hashlib
+import os
+import re
+import threading
 
 files = {}
 entry = {}
 bba = []
+_files_lock = threading.Lock()
 
-def gets(f, cmd):
-    if f in files.keys():
-        handle = files[f]
-    else:
-        handle = r2pipe.open(f, ['-2'])
-        files[f] = handle
-        entry[f] = handle.cmd("s")
+# commands whose output only depends on the analysis, the seek and settings
+_pure = re.compile(r"^(i\w*|pd\w*|pi\w*|px\w*|p8\w*|afi\w*|afl\w*|CL|pwd)(\s.*)?$")
+# commands that only change a session's state, applied lazily
+_seek = re.compile(r"^s\s+(\S.*)$")
+_setting = re.compile(r"^e\s+([^=\s]+)\s*=\s*(.*)$")
+_cd = re.compile(r"^cd\s+(.*)$")
+_hint = re.compile(r"^ahb\s+(\d+)$")
+# queries of the state that aren't worth caching
+_query = re.compile(r"^(s|e\s+[^=\s]+|s[+-].*)$")
+# analysis that is saved as a radare2 project once run
+_saved = ["aab"]
+
+cache_stats = {'hits': 0, 'misses': 0}
+
+
+class Session():
+    # one r2 process, along with the state commands have left it in
+    def __init__(self, handle, gen):
+        self.handle = handle
+        self.gen = gen  # how much of the pool's history has been applied
+        self.nhints = 0
+        self.state = {}
+
+
+class Pool():
+    # r2 processes for one ELF. Every caller thread has its own seek and
+    # settings which are replayed on whichever process runs its command, and
+    # analysis commands are replayed on every process so they all agree
+    def __init__(self, f):
+        from config import Main
+        self.f = f
+        self.size = max(1, Main.r2_pool_size)
+        self.projects = Main.r2_projects
+        m = hashlib.md5()
+        with open(f, "rb") as fd:
+            for block in iter(lambda: fd.read(65536), b""):
+                m.update(block)
+        self.md5 = m.hexdigest()
+        self.sessions = []
+        self.idle = []
+        self.history = []
+        self.hints = {}
+        self.hintlog = []
+        self.gen = 0  # bumped whenever the analysis changes
+        self.cache = {}
+        self.addrs = {}  # address of each seek expression seen, until the analysis changes
+        self.cond = threading.Condition()
+        self.local = threading.local()
+
+    def _project(self, history):
+        if any(c not in _saved for c in history):
+            return None
+        # projects saved before anal.bb.maxsize was set ahead of aac* differ
+        return "-".join(["fiddle", "bb10000", self.md5] + history)
+
+    def _has_project(self, name):
+        return name is not None and os.path.exists(os.path.join(self.projects, name))
+
+    def _open(self):
+        handle = r2pipe.open(self.f, ['-2'])
+        if self.f not in entry:
+            entry[self.f] = handle.cmd("s")
+        # before any analysis, it changes what the analysis finds
         handle.cmd('e anal.bb.maxsize=10000')
-        handle.cmd('aac*')
+        with self.cond:
+            history = list(self.history)
+        done = None
+        if self.projects:
+            if not os.path.isdir(self.projects):
+                os.makedirs(self.projects)
+            handle.cmd("e dir.projects=%s" % self.projects)
+            # start from the furthest along saved analysis
+            for i in range(len(history), -1, -1):
+                name = self._project(history[:i])
+                if self._has_project(name):
+                    handle.cmd("Po %s" % name)
+                    done = i
+                    break
+        if done is None:
+            handle.cmd('aac*')
+            done = 0
+            if self.projects:
+                handle.cmd("Ps %s" % self._project([]))
+        return Session(handle, done)
+
+    def _acquire(self):
+        with self.cond:
+            while not self.idle and len(self.sessions) >= self.size:
+                self.cond.wait()
+            if self.idle:
+                s = self.idle.pop()
+                # cheaper to reload a saved project than redo its analysis
+                if s.gen < len(self.history) and \
+                   self._has_project(self._project(self.history)):
+                    self.sessions.remove(s)
+                    s.handle.quit()
+                    s = None
+                else:
+                    return s
+            self.sessions.append(None)
+        try:
+            s = self._open()
+        except:
+            with self.cond:
+                self.sessions.remove(None)
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.sessions[self.sessions.index(None)] = s
+        return s
 
-    out = handle.cmd(cmd)
-    return out
+    def _release(self, s):
+        with self.cond:
+            self.idle.append(s)
+            self.cond.notify()
+
+    def _want(self):
+        if not hasattr(self.local, 'want'):
+            self.local.want = {}
+        return self.local.want
+
+    def _sync(self, s, want):
+        with self.cond:
+            history = self.history[s.gen:]
+            hints = self.hintlog[s.nhints:]
+        for c in history:
+            s.handle.cmd(c)
+            s.gen += 1
+        for (addr, c) in hints:
+            s.handle.cmd("%s @ 0x%x" % (c, addr))
+            s.nhints += 1
+        # seek last, settings may change how it is resolved
+        for k in sorted(want.iterkeys(), key=lambda k: k == 'seek'):
+            if s.state.get(k) != want[k]:
+                s.handle.cmd(want[k])
+                s.state[k] = want[k]
+
+    def _run(self, want, *cmds):
+        s = self._acquire()
+        try:
+            self._sync(s, want)
+            return [s.handle.cmd(c) for c in cmds]
+        finally:
+            self._release(s)
+
+    def _address(self, want, cmd):
+        # address cmd runs at, from its "@" or the caller's seek. None if it
+        # runs at many
+        if "@@" in cmd:
+            return None
+        if "@" in cmd:
+            expr = cmd.split("@", 1)[1].strip()
+        elif 'seek' in want:
+            expr = _seek.match(want['seek']).group(1).strip()
+        else:
+            expr = entry.get(self.f, "").strip()
+        try:
+            return long(expr, 0)
+        except ValueError:
+            pass
+        with self.cond:
+            addr = self.addrs.get(expr)
+        if addr is None:
+            (out,) = self._run(want, "?v %s" % expr)
+            addr = long(out.strip(), 16)
+            with self.cond:
+                self.addrs[expr] = addr
+        return addr
+
+    def cmd(self, cmd):
+        cmd = cmd.strip()
+        want = self._want()
+        if _seek.match(cmd):
+            want['seek'] = cmd
+            return ""
+        m = _setting.match(cmd)
+        if m:
+            want[('e', m.group(1))] = cmd
+            return ""
+        if _cd.match(cmd):
+            want['cd'] = cmd
+            return ""
+        if _pure.match(cmd):
+            # a hint only changes what is disassembled where it was given
+            hint = None
+            if self.hints:
+                addr = self._address(want, cmd)
+                with self.cond:
+                    hint = self.hints.get(addr) if addr is not None else len(self.hintlog)
+            key = (self.md5, self.gen, tuple(sorted(want.iteritems())), hint, cmd)
+            with self.cond:
+                out = self.cache.get(key)
+            if out is not None:
+                cache_stats['hits'] += 1
+                return out
+            cache_stats['misses'] += 1
+            (out,) = self._run(want, cmd)
+            with self.cond:
+                if key[1] == self.gen:
+                    self.cache[key] = out
+            return out
+        if _query.match(cmd):
+            if cmd == "s" or cmd.startswith("e"):
+                return self._run(want, cmd)[0]
+            # relative seek, remember where it ended up
+            (out, addr) = self._run(want, cmd, "s")
+            want['seek'] = "s %s" % addr.strip()
+            return out
+        m = _hint.match(cmd)
+        if m:
+            # hints apply to an address in every process
+            (out,) = self._run(want, "s")
+            addr = long(out.strip(), 16)
+            c = "ahb %s" % m.group(1)
+            with self.cond:
+                old = self.hints.get(addr)
+                if old != c:
+                    self.hints[addr] = c
+                    self.hintlog.append((addr, c))
+            return ""
+        # anything else may change the analysis, so every process runs it
+        s = self._acquire()
+        try:
+            self._sync(s, want)
+            out = s.handle.cmd(cmd)
+            with self.cond:
+                self.history.append(cmd)
+                s.gen = len(self.history)
+                self.gen += 1
+                self.cache = {}
+                self.addrs = {}
+                name = self._project(self.history)
+            if self.projects and name:
+                s.handle.cmd("Ps %s" % name)
+        finally:
+            self._release(s)
+        return out
+
+    def quit(self):
+        with self.cond:
+            sessions = [s for s in self.sessions if s]
+            self.sessions = []
+            self.idle = []
+        for s in sessions:
+            s.handle.quit()
+
+
+def pool(f):
+    with _files_lock:
+        if f not in files:
+            files[f] = Pool(f)
+        return files[f]
+
+
+def gets(f, cmd):
+    return pool(f).cmd(cmd)
 
 
-def run_aab(f):    
+def run_aab(f):
     if f in bba:
         return
     else:
@@ -28,12 +28,17 @@ import sys
 import os
 from memory_tree import intervaltree
 import testsuite_utils as utils
+import pure_utils
 import labeltool
 import pytable_utils
 from config import Main
 import numpy
 import importlib
+import hashlib
+import bisect
+import multiprocessing
 import db_info
+import staticdb_cache
 from ia import InstructionAnalyzer
 import r2_keeper as r2
 
@@ -72,15 +77,23 @@ class LongWriteInfo():
         else:
             r2.gets(elf, "ahb 32")
             r2.gets(elf, "e asm.bits=32")
-        self.bbs = r2.get(elf, "pdbj")
+        self.bbs = self._block()
         next = self.bbs[-1]["offset"] + self.bbs[-1]["size"]
         while next < end:
             r2.get(elf, "s 0x%x" % next)
-            self.bbs.extend(r2.get(elf, "pdbj"))
+            self.bbs.extend(self._block())
             next = self.bbs[-1]["offset"] + self.bbs[-1]["size"]
         # grab one more basic block
         r2.get(elf, "s 0x%x" % next)
-        self.bbs.extend(r2.get(elf, "pdbj"))
+        self.bbs.extend(self._block())
+
+    def _block(self):
+        # instructions of the basic block at the current seek, each tagged
+        # with where its block starts
+        bb = r2.get(self.elf, "pdbj")
+        for i in bb:
+            i["block"] = bb[0]["offset"]
+        return bb
 
     def calculate_info(self):
         # lookup write instruction
@@ -162,6 +175,12 @@ class WriteEntry(tables.IsDescription):
     reg4 = tables.StringCol(4)
     writesize = tables.Int64Col()
     halt = tables.BoolCol()  # whether to insert a breakpoint here
+    # how to get the destination from the registers, see ia.StoreEvaluator
+    lshift = tables.UInt8Col()
+    disp = tables.Int64Col()
+    subtracted = tables.BoolCol()
+    writeback = tables.UInt8Col()
+    cc = tables.UInt8Col()
 
 
 class SrcEntry(tables.IsDescription):
@@ -217,6 +236,7 @@ class FuncEntry(tables.IsDescription):
     endaddr = tables.UInt64Col()  # first address in relocation block
     endaddrlo = tables.UInt32Col()  # first address in relocation block
     endaddrhi = tables.UInt32Col()  # first address in relocation block
+    md5 = tables.StringCol(32)  # md5 of the function's code, empty if not code
 
 
 class LongWrites(tables.IsDescription):
@@ -238,6 +258,25 @@ class LongWrites(tables.IsDescription):
     endhi = tables.UInt32Col()
 
 
+class LongWriteCandidate(LongWrites):
+    fname = tables.StringCol(40)  # function the loop is in
+    stride = tables.Int64Col()  # how far the store moves each iteration, 0 if in place
+    writecount = tables.UInt64Col()  # writes made by the store in a trace
+    byteswritten = tables.UInt64Col()
+
+
+class LongWriteBlockEntry(tables.IsDescription):
+    breakaddr = tables.UInt64Col()  # longwrite this instruction belongs to
+    breakaddrlo = tables.UInt32Col()
+    breakaddrhi = tables.UInt32Col()
+    addr = tables.UInt64Col()
+    block = tables.UInt64Col()  # first address of its basic block
+    ivalue = tables.StringCol(12)
+    ilength = tables.UInt8Col()
+    type = tables.StringCol(16)  # r2's instruction type (jmp, cjmp, ...)
+    jump = tables.UInt64Col()  # branch target, 0 if it doesn't branch
+
+
 class SkipEntry(tables.IsDescription):
     pc = tables.UInt64Col()
     pclo = tables.UInt32Col()
@@ -344,6 +383,23 @@ class LongWriteDescriptor():
         r['endlo'] = utils.addr_lo(self.end)
         r['endhi'] = utils.addr_hi(self.end)
 
+    def block_rows(self):
+        # the basic blocks r2 found around the loop, so they don't have to
+        # be analyzed again at trace time
+        rows = []
+        for i in self.info.bbs:
+            value = i["bytes"].decode("hex")
+            rows.append({'breakaddr': self.breakaddr,
+                         'breakaddrlo': utils.addr_lo(self.breakaddr),
+                         'breakaddrhi': utils.addr_hi(self.breakaddr),
+                         'addr': i["offset"],
+                         'block': i["block"],
+                         'ivalue': value,
+                         'ilength': len(value),
+                         'type': i.get("type", ""),
+                         'jump': i.get("jump", 0)})
+        return rows
+
     def get_info(self):
         if not self.valid:
             return "Invalid write descriptor at %x *%s)" % (self.breakaddr,
@@ -530,39 +586,191 @@ class SkipDescriptorGenerator():
         return row
 
 
+def append_rows(table, rows):
+    # append a list of {column: value} dicts in one go
+    if not rows:
+        return
+    a = numpy.zeros(len(rows), dtype=table.dtype)
+    for (i, r) in enumerate(rows):
+        for (k, v) in r.iteritems():
+            a[k][i] = v
+    table.append(a)
+
+
+class WriteSweep():
+    # finds the write and smc instructions in an ELF's code. Each process
+    # builds its own so the sweep can be sharded across a multiprocessing pool
+    def __init__(self, elf, sections, dataranges):
+        self.ia = InstructionAnalyzer()
+        self.elfdata = open(elf, "rb").read()
+        self.sections = sections
+        self.dataranges = intervaltree.IntervalTree.from_tuples(dataranges)
+
+    @staticmethod
+    def range_bytes(elfdata, sections, start, end):
+        # contents of [start, end) as loaded from the ELF's sections
+        code = b""
+        addr = start
+        for h in sorted(sections, key=lambda h: h['address']):
+            hend = h['address'] + h['filesize']
+            if not (h['address'] <= addr < hend):
+                continue
+            n = min(end, hend) - addr
+            offset = h['offset'] + addr - h['address']
+            code += elfdata[offset:offset + n]
+            addr += n
+            if addr >= end:
+                break
+        return code
+
+    def sweep(self, code, start, thumb):
+        # linear sweep, skipping over anything capstone can't decode
+        md = self.ia.thumb if thumb else self.ia.arm
+        step = 2 if thumb else 4
+        offset = 0
+        while offset < len(code):
+            for (pc, size, mne, op_str) in md.disasm_lite(code[offset:], start + offset):
+                offset += size
+                yield (pc, size, mne, op_str)
+            if offset < len(code):
+                print "invalid instruction according to capstone: pc: %x, is thumb? %s" % \
+                    (start + offset, thumb)
+                offset += step
+
+    def __call__(self, start, end, thumb, crosscheck=None):
+        # writes, smcs and srcs rows for [start, end). srcs rows are missing
+        # their source line info, which is left to the caller
+        writes = []
+        smcs = []
+        srcs = []
+        code = self.range_bytes(self.elfdata, self.sections, start, end)
+        for (pc, size, mne, op_str) in self.sweep(code, start, thumb):
+            if crosscheck:
+                crosscheck(pc, thumb, mne)
+            ins = code[pc - start:pc - start + size]
+            if self.ia.is_mne_memstore(mne):
+                if self.dataranges.overlaps_point(pc):
+                    continue
+                inscheck = self.ia.disasm(ins, thumb, pc)
+                regs = self.ia.needed_regs(inscheck)
+                if len(regs) > 4:
+                    raise Exception("Sorry, too many registers")
+                w = {'thumb': thumb,
+                     'pc': pc,
+                     'pclo': utils.addr_lo(pc),
+                     'pchi': utils.addr_hi(pc),
+                     'halt': True,
+                     'writesize': self.ia.calculate_store_size(inscheck)}
+                for i in range(len(regs)):
+                    w['reg%d' % i] = regs[i]
+                w.update(self.ia.store_evaluator(inscheck))
+                writes.append(w)
+            elif mne == 'smc':  # add to smcs table
+                smcs.append({'pc': pc,
+                             'pclo': utils.addr_lo(pc),
+                             'pchi': utils.addr_hi(pc),
+                             'thumb': thumb})
+            else:
+                continue
+            srcs.append({'addr': pc,
+                         'addrlo': utils.addr_lo(pc),
+                         'addrhi': utils.addr_hi(pc),
+                         'ivalue': ins,
+                         'ilength': len(ins),
+                         'thumb': thumb,
+                         'disasm': ("%s %s" % (mne, op_str)).strip(),
+                         'mne': mne})
+        return (writes, smcs, srcs)
+
+    def write_loops(self, start, end, thumb):
+        # loops in [start, end) closed by a backward branch that contain
+        # exactly one store and no calls, as longwrite descriptor rows
+        code = self.range_bytes(self.elfdata, self.sections, start, end)
+        inss = list(self.sweep(code, start, thumb))
+        addrs = [i[0] for i in inss]
+        found = {}
+        for (n, (pc, size, mne, op_str)) in enumerate(inss):
+            branch = self.ia.branch_target(mne, op_str)
+            if branch is None:
+                continue
+            (top, conditional) = branch
+            first = bisect.bisect_left(addrs, top)
+            if not (start <= top <= pc) or addrs[first] != top:
+                continue
+            body = inss[first:n + 1]
+            if any(self.ia.leaves_function(i[2], i[3]) for i in body):
+                continue
+            stores = [i for i in body if self.ia.is_mne_memstore(i[2])]
+            if len(stores) != 1 or stores[0][2].startswith("push"):
+                continue
+            writeaddr = stores[0][0]
+            if self.dataranges.overlaps_point(writeaddr):
+                continue
+            if conditional:
+                contaddr = pc + size
+            else:
+                # the loop is left through a conditional branch out of it
+                exits = [b[0] for b in [self.ia.branch_target(i[2], i[3]) for i in body]
+                         if b and b[1] and not (top <= b[0] <= pc)]
+                if not exits:
+                    continue
+                contaddr = exits[0]
+            if writeaddr in found and found[writeaddr]['end'] - found[writeaddr]['start'] <= pc - top:
+                continue  # keep the innermost loop
+            detail = [self.ia.disasm(code[i[0] - start:i[0] - start + i[1]], thumb, i[0])
+                      for i in body]
+            write = detail[body.index(stores[0])]
+            writesize = self.ia.calculate_store_size(write)
+            if writesize <= 0:
+                continue
+            stride = self.ia.store_stride(write, detail)
+            if stride is None:
+                continue  # can't tell where later iterations write
+            found[writeaddr] = {'breakaddr': writeaddr,
+                                'breakaddrlo': utils.addr_lo(writeaddr),
+                                'breakaddrhi': utils.addr_hi(writeaddr),
+                                'writeaddr': writeaddr,
+                                'writeaddrlo': utils.addr_lo(writeaddr),
+                                'writeaddrhi': utils.addr_hi(writeaddr),
+                                'contaddr': contaddr,
+                                'thumb': thumb,
+                                # every iteration writes the same place
+                                'inplace': stride == 0,
+                                'writesize': writesize,
+                                'stride': stride,
+                                'start': top,
+                                'startlo': utils.addr_lo(top),
+                                'starthi': utils.addr_hi(top),
+                                'end': pc,
+                                'endlo': utils.addr_lo(pc),
+                                'endhi': utils.addr_hi(pc)}
+        return [found[a] for a in sorted(found.iterkeys())]
+
+
+_sweeper = None
+
+
+def _init_sweep_worker(elf, sections, dataranges):
+    global _sweeper
+    _sweeper = WriteSweep(elf, sections, dataranges)
+
+
+def _sweep_shard(shard):
+    return _sweeper(*shard)
+
+
 class ThumbRanges():
     @staticmethod
     def find_thumb_ranges(stage, noop=False):
-        cc = Main.cc
-        elf = stage.elf
         thumb = intervaltree.IntervalTree()
         arm = intervaltree.IntervalTree()
         data = intervaltree.IntervalTree()
         if noop:
             return (thumb, arm, data)
-        cmd = "%snm -S -n --special-syms %s 2>/dev/null" % (cc, elf)
-        output = subprocess.check_output(cmd, shell=True).split('\n')
-        prev = None
-        lo = 0
-        dta = re.compile('\s+[a-zA-Z]\s+\$[tad]$')
-        for o in output:
-            o = o.strip()
-            if dta.search(o):
-                hi = long(o[:8], 16)
-                if (prev is not None) and (not lo == hi):
-                    i = intervaltree.Interval(lo, hi)
-                    if prev == 't':
-                        thumb.add(i)
-                    elif prev == 'a':
-                        arm.add(i)
-                    elif prev == 'd':
-                        data.add(i)
-                    else:
-                        raise Exception
-                lo = hi
-                prev = o[-1]
-            else:
-                continue
+        mapping = pure_utils.elf_info(stage.elf).mapping
+        for (t, k) in [(thumb, 't'), (arm, 'a'), (data, 'd')]:
+            for (lo, hi) in mapping[k]:
+                t.add(intervaltree.Interval(lo, hi))
         res = (thumb, arm, data)
         for r in res:
             r.merge_overlaps()
@@ -584,6 +792,8 @@ class WriteSearch():
         self.srcstable = None
         self.funcstable = None
         self.longwritestable = None
+        self.longwriteblockstable = None
+        self.longwritecandidatestable = None
         self.skipstable = None
         self.verbose = verbose
         (self._thumbranges, self._armranges, self._dataranges) = (None, None, None)
@@ -596,12 +806,19 @@ class WriteSearch():
             self.group = self.h5file.create_group("/", 'staticanalysis',
                                                   "%s target static analysis"
                                                   % stage.stagename)
+            self.group._v_attrs.schema = staticdb_cache.version
         else:
             mo = "a"
             self.h5file = tables.open_file(outfile, mode=mo,
                                            title="%s target static analysis"
                                            % stage.stagename)
             self.group = self.h5file.get_node("/staticanalysis")
+            schema = getattr(self.group._v_attrs, "schema", None)
+            if not schema == staticdb_cache.version:
+                self.h5file.close()
+                raise Exception("%s was written with static analysis layout %s, not %s,"
+                                " rerun the staticanalysis task to rebuild it" %
+                                (outfile, schema, staticdb_cache.version))
         r2.cd(self.stage.elf, Main.get_runtime_config("temp_target_src_dir"))
         def q():
             try:
@@ -610,6 +827,20 @@ class WriteSearch():
                 pass
         atexit.register(q)
 
+    @staticmethod
+    def schema_current(path):
+        # whether the staticdb at path has this tree's table layout
+        try:
+            h5file = tables.open_file(path, mode="r")
+        except (IOError, tables.exceptions.HDF5ExtError):
+            return False
+        try:
+            schema = getattr(h5file.get_node("/staticanalysis")._v_attrs, "schema", None)
+        except tables.exceptions.NoSuchNodeError:
+            schema = None
+        h5file.close()
+        return schema == staticdb_cache.version
+
     @classmethod
     def _get_src_labels(cls):
         return Main.get_runtime_config("labels")()
@@ -622,6 +853,8 @@ class WriteSearch():
         self.srcstable = self.group.srcs
         self.funcstable = self.group.funcs
         self.longwritestable = self.group.longwrites
+        self.longwriteblockstable = self.group.longwriteblocks
+        self.longwritecandidatestable = self.group.longwrite_candidates
 
         self.skipstable = self.group.skips
 
@@ -655,8 +888,13 @@ class WriteSearch():
             self.create_writes_table()
         try:
             self.longwritestable = self.group.longwrites
+            self.longwriteblockstable = self.group.longwriteblocks
         except tables.exceptions.NoSuchNodeError:
             self.create_longwrites_table()
+        try:
+            self.longwritecandidatestable = self.group.longwrite_candidates
+        except tables.exceptions.NoSuchNodeError:
+            self.create_longwrite_candidates_table()
 
         try:
             self.skipstable = self.group.skips
@@ -748,6 +986,13 @@ class WriteSearch():
                 break
             addr = utils.get_line_addr("%s:%d" % (l.filename, lineno), True, stage,
                                        srcdir=Main.get_runtime_config("temp_target_src_dir"))
+            if addr < 0 and not prev:
+                # skip straight to the next line the line table has code for
+                code = utils.next_line_with_code(l.filename, lineno, stage)
+                if code is not None:
+                    if code < 0:
+                        break
+                    lineno = code - 1
 
         if addr < 0:
             return -1
@@ -771,6 +1016,9 @@ class WriteSearch():
     def create_longwrites_table(self):
         self.longwritestable = self.h5file.create_table(self.group, 'longwrites',
                                                         LongWrites, "long writes to precompute")
+        self.longwriteblockstable = self.h5file.create_table(self.group, 'longwriteblocks',
+                                                             LongWriteBlockEntry,
+                                                             "basic blocks of long writes")
         skips = []
         if not self.is_arm():
             return
@@ -800,12 +1048,73 @@ class WriteSearch():
                 print sdesc.get_info()
             r.append()
             self.longwritestable.flush()
+            append_rows(self.longwriteblockstable, sdesc.block_rows())
         self.longwritestable.cols.breakaddrlo.create_index(kind='full')
         self.longwritestable.cols.breakaddrhi.create_index(kind='full')
         self.longwritestable.flush()
+        self.longwriteblockstable.cols.breakaddrlo.create_index(kind='full')
+        self.longwriteblockstable.cols.breakaddrhi.create_index(kind='full')
+        self.longwriteblockstable.flush()
         self.writestable.flush()
         self.h5file.flush()
 
+    def create_longwrite_candidates_table(self):
+        # every loop in the image that looks like it could be a longwrite,
+        # whether or not it has a LongwriteLabel
+        self.longwritecandidatestable = self.h5file.create_table(self.group,
+                                                                 'longwrite_candidates',
+                                                                 LongWriteCandidate,
+                                                                 "write loops found in the image")
+        if not self.is_arm():
+            return
+        sweeper = WriteSweep(self.stage.elf, self._exec_sections(),
+                             [(i.begin, i.end) for i in self.dataranges])
+        found = {}
+        for (start, end, name) in pure_utils.elf_info(self.stage.elf).functions:
+            thumb = self.thumbranges.overlaps_point(start)
+            if not (thumb or self.armranges.overlaps_point(start)):
+                continue
+            for r in sweeper.write_loops(start, end, thumb):
+                r['fname'] = name
+                found.setdefault(r['writeaddr'], r)
+        append_rows(self.longwritecandidatestable,
+                    [found[a] for a in sorted(found.iterkeys())])
+        self.longwritecandidatestable.cols.writeaddrlo.create_index(kind='full')
+        self.longwritecandidatestable.cols.writeaddrhi.create_index(kind='full')
+        self.longwritecandidatestable.flush()
+        self.h5file.flush()
+        print "found %d write loop candidates" % len(found)
+
+    def rank_longwrite_candidates(self, histotable, top=20):
+        # count how much each candidate wrote according to a trace's
+        # writerange histogram
+        table = self.longwritecandidatestable
+        if table.nrows == 0:
+            return
+        hist = histotable.read()
+        rows = table.read()
+        writecount = numpy.zeros(len(rows), dtype=numpy.uint64)
+        byteswritten = numpy.zeros(len(rows), dtype=numpy.uint64)
+        if len(hist):
+            (pcs, inverse) = numpy.unique(hist['pc'], return_inverse=True)
+            ops = numpy.bincount(inverse, weights=hist['numops'])
+            nbytes = numpy.bincount(inverse, weights=hist['byteswritten'])
+            i = numpy.minimum(numpy.searchsorted(pcs, rows['writeaddr']), len(pcs) - 1)
+            hit = pcs[i] == rows['writeaddr']
+            writecount = numpy.where(hit, ops[i], 0).astype(numpy.uint64)
+            byteswritten = numpy.where(hit, nbytes[i], 0).astype(numpy.uint64)
+        table.modify_column(colname='writecount', column=writecount)
+        table.modify_column(colname='byteswritten', column=byteswritten)
+        table.flush()
+        print "hottest write loop candidates:"
+        for i in numpy.argsort(-writecount.astype(numpy.int64), kind='mergesort')[:top]:
+            if writecount[i] == 0:
+                break
+            r = rows[i]
+            print "%s: write at %x (%d writes, %d bytes), break at %x, resume at %x" % \
+                (r['fname'], r['writeaddr'], writecount[i], byteswritten[i],
+                 r['breakaddr'], r['contaddr'])
+
 
     @classmethod
     def find_label(cls, lclass, value, stage, name):
@@ -923,6 +1232,8 @@ class WriteSearch():
             self.funcstable = None
             self.relocstable = None
             self.longwritestable = None
+            self.longwriteblockstable = None
+            self.longwritecandidatestable = None
             self.stageexits = None
 
     @classmethod
@@ -962,9 +1273,7 @@ class WriteSearch():
 
     @classmethod
     def _is_arm(self, elf):
-        o = Main.shell.run_cmd("%sreadelf -h %s| grep Machine" % (Main.cc, elf))
-        o = o.split()
-        return o[1] == "ARM"
+        return pure_utils.elf_info(elf).machine == pure_utils.EM_ARM
 
     def is_arm(self):
         elf = self.stage.elf
@@ -1013,6 +1322,128 @@ class WriteSearch():
         self.writestable.reindex()
         self.h5file.flush()
 
+    def _r2_crosscheck(self, pc, thumb, mne):
+        r2.gets(self.stage.elf, "s 0x%x" % pc)
+        if thumb:  # force r2 to use the correct instruction size. sigh.
+            r2.gets(self.stage.elf, "ahb 16")
+            r2.gets(self.stage.elf, "e asm.bits=16")
+        else:
+            r2.gets(self.stage.elf, "ahb 32")
+            r2.gets(self.stage.elf, "e asm.bits=32")
+        ins_info = r2.get(self.stage.elf, "pdj 1")[0]
+        if "disasm" not in ins_info or u"invalid" == ins_info["type"] or \
+           u"invalid" == ins_info["disasm"]:
+            print "invalid instruction according to r2: pc: %x, is thumb? %s" % (pc, thumb)
+            return
+        r2mne = ins_info['disasm'].split()[0]
+        if r2mne != mne:
+            print "R2 and capstone disagree at %x %s" % (pc, thumb)
+            print "CAPSTONE ---> %s" % mne
+            print "r2 ------------------------>"
+            for (k, v) in ins_info.iteritems():
+                print "%s: %s" % (k, v)
+            if self.ia.is_mne_memstore(mne) or self.ia.is_mne_memstore(r2mne):
+                raise Exception
+            print "... But I guess it doesn't matter because neither instruction modifies memory."
+
+    def _exec_sections(self):
+        return [h for h in utils.get_section_headers(self.stage)
+                if h['flags'].endswith('x') and h['filesize'] > 0]
+
+    def _reuse_previous(self, previous, writes, smcs, srcs):
+        # carry over write/smc/src rows of functions whose bytes haven't
+        # changed since the previous staticdb, relocated to their new address.
+        # returns the (start, end) ranges that no longer need to be swept
+        try:
+            h5 = tables.open_file(previous, mode="r")
+        except (IOError, tables.exceptions.HDF5ExtError):
+            return []
+        try:
+            group = h5.get_node("/staticanalysis")
+            if 'md5' not in group.funcs.colnames:
+                return []
+            # rows of an older layout would be zero-filled where they differ
+            for (t, mine) in [(group.writes, self.writestable),
+                              (group.smcs, self.smcstable),
+                              (group.srcs, self.srcstable)]:
+                if t.colnames != mine.colnames:
+                    return []
+            oldfuncs = {}
+            for f in group.funcs.read():
+                if f['md5']:
+                    size = long(f['endaddr'] - f['startaddr'])
+                    oldfuncs[(f['fname'], size, f['md5'])] = f['startaddr']
+            old = [(group.writes.read(), 'pc', writes),
+                   (group.smcs.read(), 'pc', smcs),
+                   (group.srcs.read(), 'addr', srcs)]
+        except tables.exceptions.NoSuchNodeError:
+            return []
+        finally:
+            h5.close()
+        old = [(rows[numpy.argsort(rows[key], kind='mergesort')], key, dst)
+               for (rows, key, dst) in old]
+
+        reused = []
+        nfuncs = 0
+        for f in self.funcstable.read():
+            if not f['md5']:
+                continue
+            nfuncs += 1
+            size = long(f['endaddr'] - f['startaddr'])
+            oldstart = oldfuncs.get((f['fname'], size, f['md5']))
+            if oldstart is None:
+                continue
+            # thumb function symbols have their lowest bit set
+            oldstart = long(oldstart) & ~1
+            start = long(f['startaddr']) & ~1
+            delta = start - oldstart
+            carried = []
+            for (rows, key, dst) in old:
+                (lo, hi) = numpy.searchsorted(rows[key], [oldstart, oldstart + size])
+                for r in rows[lo:hi]:
+                    row = dict(zip(rows.dtype.names, r.tolist()))
+                    addr = row[key] + delta
+                    # same bytes, but make sure they're still decoded the same way
+                    if bool(row['thumb']) != self.thumbranges.overlaps_point(addr) or \
+                       (dst is writes and self.dataranges.overlaps_point(addr)):
+                        carried = None
+                        break
+                    row[key] = addr
+                    row[key + 'lo'] = utils.addr_lo(addr)
+                    row[key + 'hi'] = utils.addr_hi(addr)
+                    if dst is srcs:
+                        row['line'] = utils.addr2line(addr, self.stage)
+                        row['src'] = utils.line2src(row['line'])
+                    carried.append((dst, addr, row))
+                if carried is None:
+                    break
+            if carried is None:
+                continue
+            for (dst, addr, row) in carried:
+                dst[addr] = row
+            reused.append((start, start + size))
+        print "static analysis of %s: reused %d functions from %s, re-analyzing %d" % \
+            (self.stage.stagename, len(reused), previous, nfuncs - len(reused))
+        return reused
+
+    def _sweep_shards(self, ranges):
+        # split the (tree, thumb) ranges into pieces of about static_shard_size
+        # bytes, only cutting at function starts so each piece is swept from
+        # an instruction boundary
+        starts = sorted(set(long(a) & ~1 for a in self.funcstable.cols.startaddr[:]))
+        shards = []
+        for (todo, thumb) in ranges:
+            for ir in todo:
+                begin = ir.begin
+                while True:
+                    i = bisect.bisect_left(starts, begin + Main.static_shard_size)
+                    if i == len(starts) or starts[i] >= ir.end:
+                        shards.append((begin, ir.end, thumb))
+                        break
+                    shards.append((begin, starts[i], thumb))
+                    begin = starts[i]
+        return sorted(shards)
+
     def create_writes_table(self, start=0, stop=0):
         self.writestable = self.h5file.create_table(self.group, 'writes',
                                                     WriteEntry,
@@ -1026,138 +1457,60 @@ class WriteSearch():
         # now look at instructions
         if not self.is_arm():
             return
-        srcdir = Main.get_runtime_config("temp_target_src_dir")
-
-        allranges = intervaltree.IntervalTree()
-        for s in utils.get_section_headers(self.stage):
-            if s['flags'].endswith('x'):
-                if s['size'] == 0:
-                    continue
-                allranges.add(intervaltree.Interval(long(s['address']),
-                                                    long(s['address'] + s['size'])))
-        allranges.merge_overlaps()
-
-        r = self.writestable.row
-        smcr = self.smcstable.row
-        allranges = self.thumbranges | self.armranges
-
-        # loop through all instructions as according to debug symbols
+        sections = self._exec_sections()
+        crosscheck = Main.static_r2_crosscheck
+        writes = {}
+        smcs = {}
+        srcs = {}
+        reused = []
+        if Main.static_incremental:
+            previous = staticdb_cache.StaticDBCache().previous(self.stage)
+            if previous:
+                reused = self._reuse_previous(previous, writes, smcs, srcs)
+
+        # sweep all instructions as according to debug symbols, skipping
+        # over functions carried over from the previous analysis
+        todo = []
         for (ra, thumb) in [(self.thumbranges, True), (self.armranges, False)]:
-            for ir in ra:
-                pc_next = ir.begin
-                while pc_next < ir.end:
-                    pc = pc_next
-                    p = False
-                    r2.gets(self.stage.elf, "s 0x%x" % pc)
-                    if thumb: # force r2 to use the correct instruction size. sigh.
-                        r2.gets(self.stage.elf, "ahb 16")
-                        r2.gets(self.stage.elf, "e asm.bits=16")
-                    else:
-                        r2.gets(self.stage.elf, "ahb 32")
-                        r2.gets(self.stage.elf, "e asm.bits=32")
-                    r2.get(self.stage.elf, "pd 1")
-                    ins_info = r2.get(self.stage.elf, "pdj 1")[0]
-                    if p:
-                        for k,v in ins_info.iteritems():
-                            print "%s: %s" % (k, v)
-                        print "offset %x" % ins_info["offset"]
-                    insadded = False
-                    if not "disasm" in ins_info or u"invalid" == ins_info["type"] or u"invalid" == ins_info["disasm"]:
-                        print "invalid instruction according to r2: pc: %x, is thumb? %s. Using capstone to disassemble" % (pc, thumb)
-                        if 'bytes' in ins_info: # get results of capstone disassembly
-                            inscheck = self.ia.disasm(b"%s" % ins_info['bytes'].decode("hex"), thumb, pc)
-                            ins_info['disasm'] = inscheck.mnemonic + " " + inscheck.op_str
-                        else:
-                            print ins_info
-                            raise Exception()
-                    pc = ins_info['offset']
-                    dis = ins_info['disasm']
-                    val = ins_info['bytes']
-                    mne = dis.split()[0]
-                    ins = b"%s" % val.decode('hex')
-                    pc_next += ins_info['size']
-                    #... just in case radare2 doesn't properly report invalid instructions
-                    try:
-                        inscheck = self.ia.disasm(ins, thumb, pc)
-                    except StopIteration:
-                        print "Radare2 disassembled invalid instruction 0x%x (%s) as %s" % (pc, val, ins_info)
-                        continue
-                    if mne != inscheck.mnemonic:
-                        if thumb:
-                            r2.gets(self.stage.elf, "e asm.bits=16")
-                            r2.gets(self.stage.elf, "ahb 16")
-                        else:
-                            r2.gets(self.stage.elf, "ahb 32")
-                            r2.gets(self.stage.elf, "e asm.bits=32")
-                        print "R2 and capstone disagree at %x %s" % (pc, thumb)
-                        print "CAPSTONE --->"
-                        print "addr: %x" % inscheck.address
-                        print "op: %s" % inscheck.op_str
-                        print "mne: %s" % inscheck.mnemonic
-                        print "byres: %s" % ["%x" %b for b in inscheck.bytes]
-                        print "size: %s" % inscheck.size
-                        print "r2 ------------------------>"
-                        print r2.gets(self.stage.elf, "e asm.bits")
-                        for (k,v) in ins_info.iteritems():
-                            print "%s: %s" % (k, v)
-                        r2.get(self.stage.elf, "s 0x%x" % pc)
-                        print r2.gets(self.stage.elf, "pd 1")
-                        if self.ia.is_mne_memstore(mne) or self.ia.is_mne_memstore(inscheck.mnemonic):
-                            raise Exception
-                        print "... But I guess it doesn't matter because neither instruction modifies memory."
-                    if mne and self.ia.is_mne_memstore(mne):
-                        if self.dataranges.overlaps_point(pc):
-                            continue
-                        r['thumb'] = thumb
-                        r['pc'] = pc
-                        r['pclo'] = utils.addr_lo(pc)
-                        r['pchi'] = utils.addr_hi(pc)
-                        r['halt'] = True
-                        regs = self.ia.needed_regs(inscheck)
-                        if len(regs) > 4:
-                            raise Exception("Sorry, too many registers")
-                        for i in range(len(regs)):
-                            r['reg%d' % i] = regs[i]
-                        size = self.ia.calculate_store_size(inscheck)
-
-                        r['writesize'] = size
-                        insadded = True
-                        r.append()
-                    elif mne == 'smc':  # add to smcs table
-                        smcr['pc'] = pc
-                        smcr['pclo'] = utils.addr_lo(pc)
-                        smcr['pchi'] = utils.addr_hi(pc)
-                        mne = 'smc'
-                        thumb = False
-                        if self.thumbranges.overlaps_point(pc):
-                            thumb = True
-                        smcr['thumb'] = thumb
-                        insadded = True
-                        smcr.append()
-                        if self.verbose:
-                            print "smc at 0x%x" % pc
-                    if insadded:  # also cache source code information related to instruction
-                        s = self.srcstable.where("(addrlo == 0x%x) & (addrhi == 0x%x)" %
-                                                 (utils.addr_lo(pc),
-                                                  utils.addr_hi(pc)))
-                        try:
-                            s = next(s)
-                            # is in table, do nothing
-                        except StopIteration:
-                            srcr = self.srcstable.row
-                            srcr['addr'] = pc
-                            srcr['addrlo'] = utils.addr_lo(pc)
-                            srcr['addrhi'] = utils.addr_hi(pc)
-                            srcr['line'] = utils.addr2line(pc, self.stage)
-                            srcr['src'] = utils.line2src(srcr['line'])
-                            srcr['ivalue'] = ins
-                            srcr['ilength'] = len(ins)
-                            srcr['thumb'] = thumb
-                            srcr['disasm'] = dis
-                            srcr['mne'] = mne
-                            srcr.append()
-                            self.srcstable.flush()
-                        insadded = False
+            t = intervaltree.IntervalTree(ra)
+            for (start, end) in reused:
+                t.chop(start, end)
+            todo.append((t, thumb))
+        shards = self._sweep_shards(todo)
+        dataranges = [(i.begin, i.end) for i in self.dataranges]
+        workers = min(Main.static_workers or multiprocessing.cpu_count(), len(shards))
+        if crosscheck or workers <= 1:
+            # r2 sessions stay in this process
+            sweeper = WriteSweep(self.stage.elf, sections, dataranges)
+            check = self._r2_crosscheck if crosscheck else None
+            results = [sweeper(start, end, thumb, check)
+                       for (start, end, thumb) in shards]
+        else:
+            print "sweeping %d shards with %d workers" % (len(shards), workers)
+            pool = multiprocessing.Pool(workers, _init_sweep_worker,
+                                        (self.stage.elf, sections, dataranges))
+            try:
+                results = pool.map(_sweep_shard, shards, 1)
+            finally:
+                pool.close()
+                pool.join()
+        # shards are in address order, so the merge doesn't depend on scheduling
+        for (ws, ss, rs) in results:
+            for w in ws:
+                writes[w['pc']] = w
+            for smc in ss:
+                smcs[smc['pc']] = smc
+                if self.verbose:
+                    print "smc at 0x%x" % smc['pc']
+            # also cache source code information related to instruction
+            for r in rs:
+                if r['addr'] not in srcs:
+                    r['line'] = utils.addr2line(r['addr'], self.stage)
+                    r['src'] = utils.line2src(r['line'])
+                    srcs[r['addr']] = r
+        append_rows(self.writestable, [writes[pc] for pc in sorted(writes.iterkeys())])
+        append_rows(self.smcstable, [smcs[pc] for pc in sorted(smcs.iterkeys())])
+        append_rows(self.srcstable, [srcs[pc] for pc in sorted(srcs.iterkeys())])
         self.writestable.flush()
         self.writestable.cols.pclo.create_index(kind='full')
         self.writestable.cols.pchi.create_index(kind='full')
@@ -1176,23 +1529,21 @@ class WriteSearch():
         # (example: u-boot, get_tbclk)
         self.funcstable = self.h5file.create_table(self.group, 'funcs',
                                                     FuncEntry, "function info")
-        cmd = "%snm -S -n --special-syms %s 2>/dev/null" % (Main.cc, self.stage.elf)
-        output = subprocess.check_output(cmd, shell=True).split('\n')
+        elfdata = open(self.stage.elf, "rb").read()
+        sections = self._exec_sections()
         r = self.funcstable.row
-        for o in output:
-            cols = o.split()
-            if len(cols) == 4:
-                (addr, size, typ, name) = cols
-                addr = long(addr, 16)
-                size = long(size, 16)
-                r['fname'] = name
-                r['startaddr'] = addr
-                r['startaddrlo'] = utils.addr_lo(addr)
-                r['startaddrhi'] = utils.addr_hi(addr)
-                r['endaddr'] = addr + size
-                r['endaddrlo'] = utils.addr_lo(addr + size)
-                r['endaddrhi'] = utils.addr_hi(addr + size)
-                r.append()
+        for (addr, size, name) in pure_utils.elf_info(self.stage.elf).sized:
+            r['fname'] = name
+            r['startaddr'] = addr
+            r['startaddrlo'] = utils.addr_lo(addr)
+            r['startaddrhi'] = utils.addr_hi(addr)
+            r['endaddr'] = addr + size
+            r['endaddrlo'] = utils.addr_lo(addr + size)
+            r['endaddrhi'] = utils.addr_hi(addr + size)
+            code = WriteSweep.range_bytes(elfdata, sections, addr & ~1,
+                                          (addr & ~1) + size)
+            r['md5'] = hashlib.md5(code).hexdigest() if code else ""
+            r.append()
         self.funcstable.cols.startaddrlo.create_index(kind='full')
         self.funcstable.cols.endaddrlo.create_index(kind='full')
         self.funcstable.cols.startaddrhi.create_index(kind='full')
@@ -0,0 +1,137 @@
+# MIT License
+
+# Copyright (c) 2017 Rebecca ".bx" Shapiro
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from config import Main
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import pure_utils
+
+# bump when the static analysis database layout changes, staticdbs record
+# it and ones written with another layout are rebuilt
+version = 6
+
+
+def config_key(stage):
+    # everything but the ELF that static analysis output depends on: the
+    # toolchain, the stage's configuration and the labels found in the source
+    h = hashlib.md5()
+    h.update("%s\n" % version)
+    h.update("%s\n%s\n" % (stage.stagename, Main.cc))
+    h.update(json.dumps(getattr(Main.raw.TargetStage, stage.stagename),
+                        sort_keys=True, default=str))
+    labels = sorted((l.__class__.__name__, l.filename, l.lineno, l.name,
+                     str(l.stage), str(l.value))
+                    for ls in Main.raw.runtime.labels().itervalues() for l in ls)
+    for l in labels:
+        h.update("%s\n" % (l,))
+    return h.hexdigest()
+
+
+def stage_key(stage):
+    h = hashlib.md5()
+    h.update("%s\n" % pure_utils.file_md5(stage.elf))
+    h.update("%s\n" % config_key(stage))
+    return h.hexdigest()
+
+
+def _copy(src, dst):
+    # copy-on-write where the filesystem supports it
+    if subprocess.call(["cp", "--reflink=auto", src, dst]) != 0:
+        shutil.copyfile(src, dst)
+
+
+class StaticDBCache():
+    # staticdb files shared between test instances, least recently used
+    # entries are evicted once they take up more than maxsize bytes
+    def __init__(self, root=None, maxsize=None):
+        self.root = Main.staticdb_cache if root is None else root
+        self.maxsize = Main.staticdb_cache_size if maxsize is None else maxsize
+        if self.root and not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def path(self, key):
+        return os.path.join(self.root, "%s.h5" % key)
+
+    def _latest(self, stagename):
+        return os.path.join(self.root, "%s.latest" % stagename)
+
+    def previous(self, stage):
+        # most recently stored staticdb for a stage of the same name, used
+        # as the baseline for incremental analysis of a rebuilt image. Only
+        # an ELF rebuild is allowed to differ from it
+        if not self.root:
+            return None
+        try:
+            with open(self._latest(stage.stagename), "r") as f:
+                latest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(latest, dict) or latest.get('version') != version or \
+           latest.get('config') != config_key(stage):
+            return None
+        path = self.path(latest.get('key', ""))
+        return path if os.path.exists(path) else None
+
+    def fetch(self, key, target):
+        if not self.root:
+            return False
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+        _copy(path, target)
+        os.utime(path, None)
+        print "using cached static analysis %s" % path
+        return True
+
+    def store(self, key, target, stage=None):
+        if not self.root:
+            return
+        path = self.path(key)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        _copy(target, tmp)
+        os.rename(tmp, path)
+        if stage:
+            latest = self._latest(stage.stagename)
+            tmp = "%s.%d.tmp" % (latest, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({'key': key, 'version': version,
+                           'config': config_key(stage)}, f)
+            os.rename(tmp, latest)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for f in os.listdir(self.root):
+            if not f.endswith(".h5"):
+                continue
+            path = os.path.join(self.root, f)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        while entries and total > self.maxsize:
+            (mtime, size, path) = entries.pop(0)
+            os.remove(path)
+            total -= size
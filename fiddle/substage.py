@@ -911,6 +911,16 @@ class SubstagesInfo():
     def substage_numbers(cls, stage):
         return range(len(cls.substage_names(stage)))
 
+    @staticmethod
+    def _covered(allowed_writes, start, end):
+        # the allowed intervals, merged, have to hold all of [start, end)
+        pos = start
+        for i in sorted(allowed_writes.search(start, end)):
+            if i.begin > pos:
+                break
+            pos = max(pos, i.end)
+        return pos >= end
+
     def check_trace(self, table):
         violation = False
         snums = self._substage_numbers()
@@ -936,6 +946,15 @@ class SubstagesInfo():
                                                                                             start,
                                                                                             end))
                     violation = True
+            for r in db_info.get(self.stage).trace_longwrites(n):
+                start = long(r['start'])
+                end = start + long(r['writesize']) if r['inplace'] else long(r['end'])
+                if start >= end:
+                    continue
+                if not self._covered(allowed_writes, start, end):
+                    logging.info("Substage %d: invalid longwrite by pc 0x%x to addr (%x,%x)" %
+                                 (n, long(r['relocatedpc']), start, end))
+                    violation = True
         if violation:
 #            print "Policy was not violated :)"
             logging.info("Policy VIOLATED!!!1one :(")
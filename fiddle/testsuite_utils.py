@@ -25,6 +25,7 @@ from config import Main
 import re
 import os
 import pure_utils
+import dwarf_lines
 import db_info
 import r2_keeper as r2
 import json
@@ -60,8 +61,11 @@ def get_symbol_location(name, stage, debug=False):
 def addr2line(addr, stage, debug=False):
     elf = stage.elf
     cc = Main.cc
-    fn = db_info.get(stage).addr2functionname(addr)
-    return pure_utils.addr2line(addr, elf, debug, fn)
+    line = dwarf_lines.addr2line(addr, elf, cc,
+                                 Main.get_runtime_config("temp_target_src_dir"))
+    if debug:
+        print "addr2line %x -> %s" % (addr, line)
+    return line
     #
     # addr = get_symbol_location(fn, stage)
     # elf = stage.elf
@@ -79,6 +83,13 @@ def addr2line(addr, stage, debug=False):
     #     return ""
 
 def line2addrs(line, stage):
+    addrs = dwarf_lines.get(stage.elf, Main.cc).line_addrs(line)
+    if addrs is None:
+        return _gdb_line2addrs(line, stage)
+    return addrs
+
+
+def _gdb_line2addrs(line, stage):
     srcdir = Main.raw.runtime.temp_target_src_dir
     cmd = "%sgdb -ex 'dir %s' -ex 'file %s' -ex 'info line %s'  --batch --nh --nx  %s 2>/dev/null" % (Main.cc,
                                                                                                      srcdir,
@@ -112,16 +123,7 @@ def line2addrs(line, stage):
 
 
 def line2src(line):
-    try:
-        [path, lineno] = line.split(':')
-    except ValueError:
-        return ""
-    cmd = "sed -n '%s,%sp' %s 2>/dev/null" % (lineno, lineno, path)
-    try:
-        output = Main.shell.run_cmd(cmd)
-        return output
-    except:
-        return ''
+    return dwarf_lines.line2src(line)
 
 
 def addr2disasmobjdump(addr, sz, stage, thumb=True, debug=False):
@@ -159,18 +161,31 @@ def get_section_location(name, stage):
 
 
 def get_symbol_location_start_end(name, stage, debug=False):
-    elf = stage.elf
-    s = r2.get(elf, "isj")
-    for i in s:
-        if i["name"] == name:
-            addr = i["vaddr"]
-            if debug:
-                print i
-            return (addr, addr + i["size"])
-    return (-1, -1)
+    i = pure_utils.get_symbol_info(stage.elf, name, debug)
+    if i is None:
+        return (-1, -1)
+    return (i['vaddr'], i['vaddr'] + i['size'])
+
+
+def next_line_with_code(filename, lineno, stage):
+    # None if the line table doesn't know filename, -1 if no later line has code
+    table = dwarf_lines.get(stage.elf, Main.cc)
+    if not table.files(filename):
+        return None
+    code = table.next_line_with_code(filename, lineno)
+    return -1 if code is None else code
 
 
 def get_line_addr(line, start, stage, debug=False, srcdir=None):
+    addr = dwarf_lines.get(stage.elf, Main.cc).line_addr(line, start)
+    if addr is not None:
+        if debug:
+            print "%s -> %x" % (line, addr)
+        return addr
+    return _gdb_get_line_addr(line, start, stage, debug, srcdir)
+
+
+def _gdb_get_line_addr(line, start, stage, debug=False, srcdir=None):
     cc = Main.cc
     elf = stage.elf
     if srcdir:
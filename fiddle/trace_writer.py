@@ -0,0 +1,260 @@
+# MIT License
+
+# Copyright (c) 2017 Rebecca ".bx" Shapiro
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# writes traced write records to the tracedb from outside of gdb, so the
+# HDF5 work overlaps with the target running. gdb sends
+# TraceTable.write_record_dtype and longwrite_record_dtype records down the
+# writer's stdin, each batch after a fixed size header. Anything else the
+# gdb plugins need from the stages' databases is asked of the writer too,
+# so gdb never has them open
+import os
+import struct
+import cPickle as pickle
+import subprocess
+import sys
+import atexit
+import numpy
+import database
+
+WRITES = 1  # header is followed by the write records then the longwrite records
+FLUSH = 2  # flush the stage's tracedb, acknowledged with one byte
+QUIT = 3  # flush everything and exit, acknowledged with one byte
+CALL = 4  # header's first count is the length of a pickled (DBInfo method, args),
+          # answered with one byte, a length and the pickled (ok, result)
+
+header = struct.Struct("=B32sII")  # op, stage name, write and longwrite record counts
+namesize = 32
+length = struct.Struct("=I")
+dtype = database.TraceTable.write_record_dtype
+longdtype = database.TraceTable.longwrite_record_dtype
+
+
+def _read(f, n):
+    data = b""
+    while len(data) < n:
+        more = f.read(n - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+class TraceWriter():
+    # the writer process's end, owns the stages' tracedbs
+    def __init__(self, stages, fin, ack):
+        import db_info
+        self.db_info = db_info
+        self.stages = stages  # stage name -> stage
+        self.fin = fin
+        self.ack = ack
+        for s in stages.itervalues():
+            db_info.create(s, "tracedb", bulk=True)
+
+    def run(self):
+        while True:
+            h = _read(self.fin, header.size)
+            if len(h) < header.size:
+                op = QUIT  # gdb went away, keep what was sent
+            else:
+                (op, name, count, longcount) = header.unpack(h)
+                name = name.rstrip(b"\0")
+            if op == WRITES:
+                data = _read(self.fin, count * dtype.itemsize)
+                records = numpy.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
+                data = _read(self.fin, longcount * longdtype.itemsize)
+                longwrites = numpy.frombuffer(data, dtype=longdtype,
+                                              count=len(data) // longdtype.itemsize)
+                self.db_info.get(self.stages[name]).add_trace_write_records(records, longwrites)
+                continue
+            if op == CALL:
+                (method, args) = pickle.loads(_read(self.fin, count))
+                try:
+                    res = (True, getattr(self.db_info.get(self.stages[name]), method)(*args))
+                except Exception as e:
+                    res = (False, "%s: %s" % (e.__class__.__name__, e))
+                data = pickle.dumps(res, pickle.HIGHEST_PROTOCOL)
+                self.ack.write(b"k" + length.pack(len(data)) + data)
+                self.ack.flush()
+                continue
+            if op == FLUSH:
+                self.db_info.get(self.stages[name]).flush_tracedb()
+            else:
+                for s in self.stages.itervalues():
+                    self.db_info.get(s).flush_tracedb()
+            if len(h) == header.size:
+                self.ack.write(b"k")
+                self.ack.flush()
+            if op == QUIT:
+                return
+
+
+def _check_names(stages):
+    for s in stages:
+        if len(s.stagename) > namesize:
+            raise ValueError("stage name '%s' is longer than the trace writer's %d bytes" %
+                             (s.stagename, namesize))
+
+
+class TraceWriterProcess():
+    # gdb's end of a writer process. If the writer goes away its work is
+    # carried on from gdb, batches it hadn't flushed yet are lost
+    def __init__(self, python, stages, instance, trace):
+        _check_names(stages)
+        self.stages = stages
+        self.names = set(s.stagename for s in stages)
+        cmd = [python, os.path.abspath(__file__), instance or "", trace or ""] + \
+            [s.stagename for s in stages]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.closed = False
+        self.local = None
+        atexit.register(self.close)
+
+    def _name(self, stage):
+        if stage.stagename not in self.names:
+            raise ValueError("trace writer was not started for stage %s" % stage.stagename)
+        return stage.stagename
+
+    def _send(self, op, stagename="", data=b"", longdata=b"", count=None):
+        if count is None:
+            count = len(data) // dtype.itemsize
+        self.proc.stdin.write(header.pack(op, stagename, count,
+                                          len(longdata) // longdtype.itemsize))
+        for d in [data, longdata]:
+            if d:
+                self.proc.stdin.write(d)
+        self.proc.stdin.flush()
+
+    def _wait_ack(self):
+        if self.proc.stdout.read(1) != b"k":
+            raise IOError("trace writer (pid %d) went away" % self.proc.pid)
+
+    def _failed(self, e):
+        print "trace writer (pid %d) failed (%s), writing traces from gdb" % (self.proc.pid, e)
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+        self.local = LocalTraceWriter(self.stages, create=False)
+
+    def send(self, stage, records, longwrites=None):
+        if self.local is None:
+            longdata = b""
+            if longwrites is not None:
+                longdata = numpy.ascontiguousarray(longwrites, dtype=longdtype).tobytes()
+            try:
+                self._send(WRITES, self._name(stage),
+                           numpy.ascontiguousarray(records, dtype=dtype).tobytes(), longdata)
+                return
+            except (IOError, OSError) as e:
+                self._failed(e)
+        self.local.send(stage, records, longwrites)
+
+    def flush(self, stage):
+        if self.local is None:
+            try:
+                self._send(FLUSH, self._name(stage))
+                self._wait_ack()
+                return
+            except (IOError, OSError) as e:
+                self._failed(e)
+        self.local.flush(stage)
+
+    def call(self, stage, method, *args):
+        # DBInfo method of stage's, run by the writer
+        if self.local is None:
+            data = pickle.dumps((method, args), pickle.HIGHEST_PROTOCOL)
+            try:
+                self._send(CALL, self._name(stage), data, count=len(data))
+                self._wait_ack()
+                n = self.proc.stdout.read(length.size)
+                if len(n) < length.size:
+                    raise IOError("trace writer (pid %d) went away" % self.proc.pid)
+                (ok, res) = pickle.loads(_read(self.proc.stdout, length.unpack(n)[0]))
+            except (IOError, OSError, EOFError) as e:
+                self._failed(e)
+            else:
+                if not ok:
+                    raise Exception("trace writer %s failed: %s" % (method, res))
+                return res
+        return self.local.call(stage, method, *args)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.local is not None:
+            return
+        try:
+            self._send(QUIT)
+            self._wait_ack()
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError) as e:
+            self._failed(e)
+
+
+class LocalTraceWriter():
+    # stand-in that does the writer's work in the calling process
+    def __init__(self, stages=[], create=True):
+        import db_info
+        self.db_info = db_info
+        if create:
+            for s in stages:
+                db_info.create(s, "tracedb", bulk=True)
+
+    def send(self, stage, records, longwrites=None):
+        self.db_info.get(stage).add_trace_write_records(records, longwrites)
+
+    def flush(self, stage):
+        self.db_info.get(stage).flush_tracedb()
+
+    def call(self, stage, method, *args):
+        return getattr(self.db_info.get(stage), method)(*args)
+
+    def close(self):
+        pass
+
+
+def launch(stages, instance, trace):
+    from config import Main
+    _check_names(stages)
+    if Main.trace_writer:
+        try:
+            return TraceWriterProcess(Main.trace_writer, stages, instance, trace)
+        except OSError as e:
+            print "could not start trace writer '%s' (%s), writing traces from gdb" % \
+                (Main.trace_writer, e)
+    return LocalTraceWriter(stages)
+
+
+if __name__ == "__main__":
+    (instance, trace) = sys.argv[1:3]
+    # stdout is for acknowledgements, anything printed goes to stderr
+    ack = os.fdopen(os.dup(1), "wb", 0)
+    os.dup2(2, 1)
+    from config import Main
+    import doit_manager
+    doit_manager.TaskManager(doit_manager.cmds.hook, instance or None, trace or None,
+                             None, [], [], {}, [])
+    stages = {n: Main.stage_from_name(n) for n in sys.argv[3:]}
+    TraceWriter(stages, sys.stdin, ack).run()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+# time GDBTargetController.set_mode's core state decision per breakpoint
+# stop, worked out from scratch every stop as set_mode used to (mapping
+# symbols from nm into interval trees, testsuite_utils.addr2functionname's
+# r2 seeks and afi, then an interval tree search) against
+# pure_utils.CoreStates' sorted ranges and per-pc memo. Also counts how many
+# "mon arm core_state" commands each would have sent.
+#   core_state_benchmark.py elf [-n stops] [-p distinct pcs]
+
+import argparse
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+self_path = __file__
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(self_path)), "..", "..", "fiddle"))
+from config import Main
+from memory_tree import intervaltree
+import pure_utils
+import r2_keeper as r2
+import testsuite_utils as utils
+from staticanalysis import ThumbRanges
+
+
+class BenchStage():
+    def __init__(self, elf):
+        self.elf = elf
+        self.stagename = os.path.basename(elf)
+
+
+def nm_thumb_ranges(stage):
+    # ThumbRanges.find_thumb_ranges as it was before it read the ELF itself
+    cmd = "%snm -S -n --special-syms %s 2>/dev/null" % (Main.cc, stage.elf)
+    output = subprocess.check_output(cmd, shell=True).split('\n')
+    res = {'t': intervaltree.IntervalTree(), 'a': intervaltree.IntervalTree(),
+           'd': intervaltree.IntervalTree()}
+    prev = None
+    lo = 0
+    dta = re.compile('\s+[a-zA-Z]\s+\$[tad]$')
+    for o in output:
+        o = o.strip()
+        if dta.search(o):
+            hi = long(o[:8], 16)
+            if (prev is not None) and (not lo == hi):
+                res[prev].add(intervaltree.Interval(lo, hi))
+            lo = hi
+            prev = o[-1]
+    for r in res.itervalues():
+        r.merge_overlaps()
+        r.merge_equals()
+    return (res['t'], res['a'], res['d'])
+
+
+def scratch(stage, pcs):
+    state = None
+    changes = 0
+    for addr in pcs:
+        (ts, arms, ds) = nm_thumb_ranges(stage)
+        if utils.addr2functionname(addr, stage) == "clear_bss":
+            typ = "thumb"
+        elif arms.search(addr):
+            typ = "arm"
+        else:
+            typ = "thumb"
+        if not typ == state:
+            state = typ
+            changes += 1
+    return changes
+
+
+def memoized(stage, pcs):
+    (ts, arms, ds) = ThumbRanges.find_thumb_ranges(stage)
+    states = pure_utils.CoreStates(stage.elf, [(i.begin, i.end) for i in arms])
+    state = None
+    changes = 0
+    for addr in pcs:
+        typ = states(addr)
+        if not typ == state:
+            state = typ
+            changes += 1
+    return changes
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('elf')
+    parser.add_argument('-n', '--stops', type=int, default=20000)
+    parser.add_argument('-p', '--pcs', type=int, default=1000)
+    args = parser.parse_args()
+    stage = BenchStage(args.elf)
+    info = pure_utils.elf_info(args.elf)
+    rng = random.Random(0)
+    # breakpoints at function starts, hit in a random order
+    starts = [f[0] for f in info.functions] or [0]
+    bps = [rng.choice(starts) for i in range(args.pcs)]
+    pcs = [rng.choice(bps) for i in range(args.stops)]
+    for (name, f) in [("scratch", scratch), ("memoized", memoized)]:
+        start = time.time()
+        changes = f(stage, pcs)
+        elapsed = time.time() - start
+        print "%s: %d stops in %fs (%f stops/s), %d core_state commands" % \
+            (name, len(pcs), elapsed, len(pcs) / elapsed, changes)
+    r2.files[args.elf].quit()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+# breakpoint stops/sec when each register is printed on its own (the old
+# GDBTargetController.get_reg_value) against one snapshot per stop.
+# run inside gdb:
+#   gdb -q -batch -x reg_snapshot_benchmark.py [--args program]
+# without a program a small store loop is built with gcc. Set
+# REG_BENCH_STOPS and REG_BENCH_BREAK to change the stop count and location
+
+import gdb
+import os
+import subprocess
+import sys
+import tempfile
+import time
+self_path = __file__
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(self_path)), "..", "..", "fiddle_gdb"))
+import gdb_tools
+
+loop = """
+volatile int sink;
+void store(int i) { sink = i; }
+int main(void) { int i; for (i = 0; i < 100000000; i++) store(i); return 0; }
+"""
+
+
+class CountBreak(gdb.Breakpoint):
+    def __init__(self, spec, controller, regs, snapshot, stops):
+        gdb.Breakpoint.__init__(self, spec, internal=True)
+        self.controller = controller
+        self.regs = regs
+        self.snapshot = snapshot
+        self.stops = stops
+        self.count = 0
+
+    def stop(self):
+        c = self.controller
+        # what a WriteBreak stop and its write hook read, pc twice
+        if self.snapshot:
+            c.clear_reg_cache()
+            c.get_reg_values(self.regs)
+            c.get_reg_value('pc')
+        else:
+            for r in self.regs + ['pc']:
+                c.print_reg_value(r, True)
+        self.count += 1
+        return self.count >= self.stops
+
+
+def build():
+    d = tempfile.mkdtemp()
+    src = os.path.join(d, "loop.c")
+    with open(src, "w") as f:
+        f.write(loop)
+    out = os.path.join(d, "loop")
+    subprocess.check_call(["gcc", "-O0", "-g", "-o", out, src])
+    return out
+
+
+def bench(controller, spec, stops, snapshot):
+    gdb.execute("start", to_string=True)
+    arch = gdb.selected_frame().architecture().name()
+    if "arm" in arch:
+        regs = ['pc', 'cpsr', 'lr', 'r0', 'r1', 'r2']
+    else:
+        regs = ['pc', 'sp', 'fp']
+    b = CountBreak(spec, controller, regs, snapshot, stops)
+    start = time.time()
+    gdb.execute("continue", to_string=True)
+    elapsed = time.time() - start
+    n = b.count
+    b.delete()
+    gdb.execute("kill", to_string=True)
+    return (n, elapsed)
+
+
+def run():
+    stops = int(os.environ.get("REG_BENCH_STOPS", 20000))
+    spec = os.environ.get("REG_BENCH_BREAK", "store")
+    if not gdb.current_progspace().filename:
+        gdb.execute("file %s" % build(), to_string=True)
+    controller = gdb_tools.GDBTargetController()
+    for (name, snapshot) in [("print", False), ("snapshot", True)]:
+        (n, elapsed) = bench(controller, spec, stops, snapshot)
+        print "%s: %d stops in %fs (%f stops/s)" % (name, n, elapsed, n / elapsed)
+
+
+run()
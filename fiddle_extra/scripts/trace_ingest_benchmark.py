@@ -0,0 +1,62 @@
+#!/usr/bin/env python2
+# compares writes table ingest rate through TraceTable.add_write_entries
+# when the full indexes are maintained during the load (default mode)
+# against building them once when the table is closed (bulk mode).
+# Tables are written to a scratch file, using a configured stage's
+# relocation information:
+#   trace_ingest_benchmark.py stage [-i instance] [-t trace] [-n rows] [-c chunk]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy
+self_path = __file__
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(self_path)), "..", "..", "fiddle"))
+from config import Main
+import database
+import doit_manager
+import pure_utils
+
+
+def ingest(path, stage, nrows, chunk, bulk):
+    (lo, hi) = pure_utils.get_min_max_pcs(stage.elf)
+    t = database.TraceTable(path, stage, True, True, bulk=bulk)
+    rng = numpy.random.RandomState(0)
+    start = time.time()
+    for i in range(0, nrows, chunk):
+        n = min(chunk, nrows - i)
+        pc = rng.randint(lo, hi, n)
+        t.add_write_entries({'time': numpy.full(n, start), 'pid': numpy.zeros(n),
+                             'size': numpy.full(n, 4), 'dest': rng.randint(lo, hi, n),
+                             'pc': pc, 'lr': pc, 'cpsr': numpy.zeros(n),
+                             'substage': numpy.zeros(n)})
+    t.writestable.flush()
+    loaded = time.time() - start
+    # builds the indexes in bulk mode
+    t.close()
+    total = time.time() - start
+    return (loaded, total)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("trace ingest benchmark")
+    parser.add_argument('stage')
+    parser.add_argument('-i', '--instance', action="store", default=None)
+    parser.add_argument('-t', '--trace', action="store", default=None)
+    parser.add_argument('-n', '--rows', action="store", default=1000000, type=int)
+    parser.add_argument('-c', '--chunk', action="store", default=4096, type=int)
+    args = parser.parse_args()
+    doit_manager.TaskManager(doit_manager.cmds.hook, args.instance, args.trace,
+                             None, [], [], {}, [])
+    stage = Main.stage_from_name(args.stage)
+    d = tempfile.mkdtemp()
+    for (name, bulk) in [("indexed", False), ("bulk", True)]:
+        path = os.path.join(d, "%s.h5" % name)
+        (loaded, total) = ingest(path, stage, args.rows, args.chunk, bulk)
+        print "%s: %d rows loaded in %fs, %fs with indexes (%d rows/s)" % (name, args.rows,
+                                                                         loaded, total,
+                                                                         args.rows / total)
+        os.remove(path)
+    os.rmdir(d)
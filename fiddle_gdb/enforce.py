@@ -27,7 +27,6 @@ import signal
 from fiddle.memory_tree import intervaltree
 import gdb_tools
 import substage
-import db_info
 
 
 # def int_repr(self):
@@ -135,13 +134,16 @@ class Enforce(gdb_tools.GDBPlugin):
             name = s.stage.stagename
             # policy = self.controller.policy_file
             ss = self.controller._stages[name].substages_entrypoints
-            i = db_info.get(s.stage)
+            # read from the policy db by the trace writer, gdb keeps no db open
+            writer = self.controller.start_trace_writer()
             allowed_writes[name] = {}
 
             for n in range(0, len(ss)):
-                allowed_writes[name][n] = i.allowed_substage_writes(n)
+                allowed_writes[name][n] = writer.call(s.stage, "allowed_substage_writes", n)
 
     def write_stophook(self, bp, ret):
+        if bp.writeinfo['start'] is None:  # a conditional store that didn't happen
+            return ret
         return self.longwrite_stophook(bp, ret)
 
     def substage_stophook(self, bp, ret):
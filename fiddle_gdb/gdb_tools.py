@@ -28,6 +28,7 @@ import argparse
 import signal
 import re
 import importlib
+import bisect
 
 #import capstone
 #from capstone.arm import *
@@ -35,6 +36,27 @@ import importlib
 
 breakpoint_classes = {}
 now = False
+# a line of openocd's "reg" output, "(15) pc (/32): 0x402007e4" when
+# listing, "pc (/32): 0x402007e4" when reading one register
+_mon_reg = re.compile(r"^(?:\(\d+\)\s+)?(\w+)\s+\(/\d+\):\s+(0x[0-9a-fA-F]+)", re.MULTILINE)
+# openocd's suffix for the registers banked by each ARM mode (cpsr & 0x1f)
+_arm_banks = {0x10: "usr", 0x11: "fiq", 0x12: "irq", 0x13: "svc", 0x16: "mon",
+              0x17: "abt", 0x1a: "hyp", 0x1b: "und", 0x1f: "usr"}
+
+
+def _banked_name(reg, cpsr):
+    # the name openocd gives reg in cpsr's mode
+    bank = _arm_banks.get(cpsr & 0x1f, "usr")
+    reg = {"r13": "sp", "r14": "lr"}.get(reg, reg)
+    if reg == "sp" or (reg == "lr" and not bank == "hyp"):
+        return "%s_%s" % (reg, bank)
+    if reg == "lr":
+        return "lr_usr"
+    if bank == "fiq" and reg in ("r8", "r9", "r10", "r11", "r12"):
+        return "%s_fiq" % reg
+    return reg
+
+
 gdb.execute('set pagination off')
 gdb.execute('set height unlimited')
 gdb.execute('set confirm off')
@@ -50,6 +72,89 @@ class BreakpointRegistrar(type):
         return newcls
 
 
+class BreakpointRegistry(object):
+    # every live TargetBreak, indexed by class name, address and stage name
+    def __init__(self):
+        self.bps = set()
+        self.by_class = {}
+        self.by_addr = {}
+        self.by_stage = {}
+        self._addrs = None  # sorted addresses, rebuilt on demand
+
+    def _indexes(self, b):
+        return [(self.by_class, GDBTargetController._clsname(b)),
+                (self.by_addr, b.addr),
+                (self.by_stage, b.stage.stagename)]
+
+    def add(self, b):
+        self.bps.add(b)
+        for (index, key) in self._indexes(b):
+            index.setdefault(key, set()).add(b)
+        self._addrs = None
+
+    def remove(self, b):
+        if b not in self.bps:
+            return
+        self.bps.discard(b)
+        for (index, key) in self._indexes(b):
+            s = index.get(key)
+            if s is not None:
+                s.discard(b)
+                if not s:
+                    del index[key]
+        self._addrs = None
+
+    def readdress(self, b, old):
+        s = self.by_addr.get(old)
+        if s is not None:
+            s.discard(b)
+            if not s:
+                del self.by_addr[old]
+        self.by_addr.setdefault(b.addr, set()).add(b)
+        self._addrs = None
+
+    def __contains__(self, b):
+        return b in self.bps
+
+    def __iter__(self):
+        return iter(list(self.bps))
+
+    def __len__(self):
+        return len(self.bps)
+
+    def in_range(self, lo, hi):
+        # breakpoints at lo <= addr < hi
+        if self._addrs is None:
+            self._addrs = sorted(self.by_addr.iterkeys())
+        res = set()
+        for a in self._addrs[bisect.bisect_left(self._addrs, lo):
+                             bisect.bisect_left(self._addrs, hi)]:
+            res.update(self.by_addr[a])
+        return res
+
+    def find(self, classes=None, addr=None, stage=None):
+        # classes match subclasses too, like isinstance
+        sets = []
+        if classes is not None:
+            if not isinstance(classes, list):
+                classes = [classes]
+            classes = tuple(classes)
+            s = set()
+            for (name, bs) in self.by_class.iteritems():
+                cls = breakpoint_classes.get(name)
+                if cls is not None and issubclass(cls, classes):
+                    s.update(bs)
+            sets.append(s)
+        if addr is not None:
+            sets.append(self.by_addr.get(addr, set()))
+        if stage is not None:
+            sets.append(self.by_stage.get(stage.stagename, set()))
+        if not sets:
+            return list(self.bps)
+        sets.sort(key=len)
+        return list(sets[0].intersection(*sets[1:]))
+
+
 class TargetStageData(gdb.Command):
     def __init__(self, stage, stop_hooks):
         self.stage = stage
@@ -139,7 +244,7 @@ class GDBTargetCommandHandler(gdb.Command):
 
 class GDBTargetController(object):
     def __init__(self):
-        self.breakpoints = []
+        self.breakpoints = BreakpointRegistry()
         self.gone = False
         self.stages_with_policies = []
         self.disabled_breakpoints = set()
@@ -157,6 +262,13 @@ class GDBTargetController(object):
         self.cmds = []
         self.subcommand_parsers = {}
         self.core_state = None
+        self.core_states = {}  # stage name -> pure_utils.CoreStates
+        self.regs = {}  # register values read since the target last stopped
+        self.last_cpsr = 0x13  # which registers were banked in at the last stop
+        self.trace_writer = None
+        self.instr_values = {}  # stage name -> pc -> instruction bytes from the static db
+        self.write_pcs = set()  # where write breakpoints are
+        self.code_written = set()  # write breakpoints whose instruction was written over
         self.current_substage = 0
         self.current_substage_name = ""
         self.current_stage = None
@@ -276,20 +388,29 @@ class GDBTargetController(object):
         if self.run_standalone:
             return
         if self.isbaremetal:
-            addr = self.get_reg_value('pc')
-            (ts, arms, ds) = getattr(Main.raw.runtime.thumb_ranges, self.current_stage.stagename)()
-            # hack
-            if utils.addr2functionname(addr, self.current_stage) == "clear_bss":
-                typ = "thumb"
-            elif arms.search(addr):
-                typ = "arm"
-            else:
-                typ = "thumb"
+            typ = self.stage_core_states(self.current_stage)(self.get_reg_value('pc'))
             if not typ == self.core_state:
                 self.core_state = typ
                 gdb.execute("mon arm core_state %s" % typ, to_string=True)
 
-    def get_instr_value(self, addr, thumb):
+    def stage_core_states(self, stage):
+        # thumb ranges are only worked out once per stage
+        if stage.stagename not in self.core_states:
+            ranges = getattr(Main.raw.runtime.thumb_ranges, stage.stagename)
+            if callable(ranges):
+                ranges = ranges()
+            (ts, arms, ds) = ranges
+            self.core_states[stage.stagename] = pure_utils.CoreStates(stage.elf,
+                                                                      [(i.begin, i.end)
+                                                                       for i in arms])
+        return self.core_states[stage.stagename]
+
+    def get_instr_value(self, addr, thumb, stage=None, inspc=None):
+        # static db's copy unless the code may have changed since
+        if stage is not None and addr not in self.code_written:
+            val = self.instr_values.get(stage.stagename, {}).get(inspc)
+            if val is not None:
+                return val
         size = 'w'
         if self.isbaremetal:
             gdb.execute("mon gdb_sync")
@@ -301,7 +422,8 @@ class GDBTargetController(object):
         val = val[::-1]
         return val
 
-    def get_reg_value(self, reg, force=False):
+    def print_reg_value(self, reg, force=False):
+        # one register, one round trip
         if self.isbaremetal:
             gdb.execute("mon gdb_sync")
             if force:
@@ -312,18 +434,89 @@ class GDBTargetController(object):
                     pass
         return long(gdb.execute("print/x $%s" % reg, to_string=True).split()[2], 16)
 
-    def get_breaks(self, cls):
-        if not isinstance(cls, list):
-            cls = [cls]
-        return [b.companion for b in self.breakpoints
-                if any(map(lambda c: isinstance(b, c), cls))]
+    def check_code_write(self, start, end):
+        # catch writes over an instruction that is being served from the
+        # static db, an instruction that started up to 2 bytes before counts
+        for addr in xrange((start & ~1) - 2, end, 2):
+            if addr in self.write_pcs:
+                self.code_written.add(addr)
+
+    def clear_reg_cache(self, *args):
+        self.regs = {}
+
+    def _mon_reg_force(self, regs, cpsr):
+        # read the registers from the target, not openocd's copy, with one
+        # monitor command. Returns the values found by register name
+        names = {}
+        for r in regs:
+            names.setdefault(_banked_name(r, cpsr), []).append(r)
+        # each [reg] is substituted with what it prints, older openocds print
+        # it straight away instead, either way one line per register comes back
+        out = gdb.execute("mon join [list %s] \"\\n\"" %
+                          " ".join("[reg %s force]" % n for n in names), to_string=True)
+        found = {}
+        for m in _mon_reg.finditer(out):
+            for r in names.get(m.group(1), []):
+                found[r] = long(m.group(2), 16)
+        return found
+
+    def get_reg_values(self, regs, force=False):
+        # snapshot every register asked for at once, kept until the target runs
+        if force:
+            for r in regs:
+                self.regs.pop(r, None)
+        missing = [r for r in regs if r not in self.regs]
+        if missing:
+            if self.isbaremetal:
+                gdb.execute("mon gdb_sync")
+                # guess the mode is the last stop's, cpsr says if it was right
+                cpsr = self.regs.get('cpsr', self.last_cpsr)
+                want = missing if 'cpsr' in self.regs else missing + ['cpsr']
+                found = self._mon_reg_force(want, cpsr)
+                if 'cpsr' in found and \
+                   not _arm_banks.get(found['cpsr'] & 0x1f) == _arm_banks.get(cpsr & 0x1f):
+                    # wrong guess, read the banked ones again
+                    banked = [r for r in missing
+                              if not _banked_name(r, cpsr) == _banked_name(r, found['cpsr'])]
+                    for r in banked:
+                        found.pop(r, None)
+                    found.update(self._mon_reg_force(banked, found['cpsr']))
+                for (r, v) in found.iteritems():
+                    if r in want:
+                        self.regs[r] = v
+                if 'cpsr' in self.regs:
+                    self.last_cpsr = self.regs['cpsr']
+            else:
+                try:
+                    frame = gdb.selected_frame()
+                    for r in missing:
+                        v = frame.read_register(r)
+                        self.regs[r] = long(v) & ((1 << (8 * v.type.sizeof)) - 1)
+                except (gdb.error, ValueError):
+                    pass
+            for r in missing:
+                if r not in self.regs:
+                    self.regs[r] = self.print_reg_value(r, True)
+        return [self.regs[r] for r in regs]
+
+    def get_reg_value(self, reg, force=False):
+        if reg in self.regs and not force:
+            return self.regs[reg]
+        return self.get_reg_values([reg], force)[0]
+
+    def get_breaks(self, cls, stage=None):
+        return self.breakpoints.find(classes=cls, stage=stage)
 
     def insert_breakpoints(self, stage):
+        start = time.time()
         self.insert_write_breakpoints(stage)
         self.insert_reloc_breakpoints(stage)
         self.insert_longwrites_breakpoints(stage)
         self.insert_substagestart_breakpoints(stage)
         self.insert_stageend_breakpoints(stage)
+        self.gdb_print("inserted %d breakpoints for %s in %fs\n" %
+                       (len(self.breakpoints.find(stage=stage)), stage.stagename,
+                        time.time() - start))
 
     def insert_stageend_breakpoints(self, stage):
         if self.run_standalone:
@@ -338,7 +531,7 @@ class GDBTargetController(object):
     def insert_substagestart_breakpoints(self, stage):
         if self.run_standalone:
             return
-        if any(map(lambda x: "SubstageEntryBreak" == x, self.disabled_breakpoints)):
+        if "SubstageEntryBreak" in self.disabled_breakpoints:
             return
         sname = stage.stagename
         s_info = self._stages[sname]
@@ -352,7 +545,7 @@ class GDBTargetController(object):
     def insert_longwrites_breakpoints(self, stage):
         if self.run_standalone:
             return
-        if any(map(lambda x: x == "LongwriteBreak", self.disabled_breakpoints)):
+        if "LongwriteBreak" in self.disabled_breakpoints:
             return
 
         for r in db_info.get(stage).longwrites_info():
@@ -361,7 +554,7 @@ class GDBTargetController(object):
     def insert_reloc_breakpoints(self, stage):
         if self.run_standalone:
             return
-        if any(map(lambda x: x == "RelocBreak", self.disabled_breakpoints)):
+        if "RelocBreak" in self.disabled_breakpoints:
             return
         for r in db_info.get(stage).reloc_info():
             RelocBreak(self, stage, r)
@@ -369,18 +562,17 @@ class GDBTargetController(object):
     def enable_write_breaks(self, stage, enable=True):
         if self.run_standalone:
             return
-        for bp in self.breakpoints:
-            b = bp.companion
-            if isinstance(b, WriteBreak) or isinstance(b, LongwriteBreak):
-                self.disable_breakpoint(b, disable=not enable, delete=False)
+        self.enable_breaks(self.get_breaks([WriteBreak, LongwriteBreak], stage), enable)
 
     def insert_write_breakpoints(self, stage):
         if self.run_standalone:
             return
-        if any(map(lambda x: x == "WriteBreak", list(self.disabled_breakpoints))):
+        if "WriteBreak" in self.disabled_breakpoints:
             return
         i = 0
         n = db_info.get(stage).num_writes()
+        evaluators = db_info.get(stage).write_evaluators()
+        self.instr_values[stage.stagename] = db_info.get(stage).instr_values()
         self.gdb_print("%d write breakpoints\n" % n)
         for (pc, halt) in db_info.get(stage).write_info():
             if halt is True:
@@ -397,7 +589,7 @@ class GDBTargetController(object):
                                % pc)
                 continue
             i = i + 1
-            WriteBreak(pc, self, stage)
+            WriteBreak(pc, self, stage, evaluators.get(long(pc)))
         self.gdb_print("actually inserted %s of %s write breakpoints\n" % (i, n))
 
     def until(self, args):
@@ -501,8 +693,7 @@ class GDBTargetController(object):
         self.enable_write_breaks(self.current_stage, enable)
 
     def enable_current_stage_end_break(self, enable=True):
-        for e in self._stages[self.current_stage.stagename].endbreaks:
-            self.disable_breakpoint(e, disable=not enable, delete=False)
+        self.enable_breaks(self._stages[self.current_stage.stagename].endbreaks, enable)
 
     def prepare_stage(self, stage, cont=False):
         self.current_stage = stage
@@ -535,11 +726,23 @@ class GDBTargetController(object):
         for f in self.f_hooks:
             f(args)
 
+    def start_trace_writer(self):
+        # process that writes the traced writes to the stages' tracedbs,
+        # or a stand-in that does so from gdb if one can't be run
+        if self.trace_writer is None:
+            self.trace_writer = trace_writer.launch(self.stage_order,
+                                                    self.test_instance_name,
+                                                    self.test_trace_name)
+        return self.trace_writer
+
     def delete_stage_breakpoints(self, stage):
-        global breakpoint_classes
-        for b in self.get_breaks(list(breakpoint_classes.itervalues())):
-            if b.stage == stage:
-                self.disable_breakpoint(b, delete=b.name == "StageEndBreak")
+        start = time.time()
+        bps = self.breakpoints.find(stage=stage)
+        ends = self.breakpoints.find(classes=StageEndBreak, stage=stage)
+        self.enable_breaks(set(bps) - set(ends), False)
+        self.delete_breaks(ends)
+        self.gdb_print("removed %d breakpoints of %s in %fs\n" %
+                       (len(bps), stage.stagename, time.time() - start))
 
     def spec_to_addr(self, spec):
         addr = -1
@@ -559,17 +762,64 @@ class GDBTargetController(object):
         return addr
 
     def disable_breakpoint(self, b, disable=True, delete=True):
-        bp = b.breakpoint
-        addr = self.spec_to_addr(bp.location)
-        bp.enabled = not disable
         if disable and delete:
-            if b in self.breakpoints:
-                self.breakpoints.remove(b)
-            gdb.post_event(lambda: self._delete_bp(bp, addr))
-
-    def _delete_bp(self, bp, addr):
+            self.delete_breaks([b])
+        else:
+            self.enable_breaks([b], not disable)
+
+    def enable_breaks(self, bps, enable=True):
+        # only touch the gdb breakpoints whose state changes
+        for b in bps:
+            bp = b.breakpoint
+            if bp is not None and bp.is_valid() and not bp.enabled == enable:
+                bp.enabled = enable
+
+    def delete_breaks(self, bps):
+        # disabled now, the gdb breakpoints are all deleted by one event
+        gone = []
+        for b in bps:
+            self.breakpoints.remove(b)
+            if b.breakpoint is not None:
+                gone.append(b.breakpoint)
+        self._disable_and_delete(gone)
+
+    def _disable_and_delete(self, gone):
+        for bp in gone:
+            if bp.is_valid():
+                bp.enabled = False
+        if gone:
+            gdb.post_event(lambda: self._delete_bps(gone))
+
+    def _delete_bps(self, gone):
         if not self.isbaremetal:
-            bp.delete()
+            for bp in gone:
+                if bp.is_valid():
+                    bp.delete()
+
+    def relocate_breaks(self, bps, offset, mod, delorig=False):
+        old = []
+        for b in bps:
+            if not b.needs_relocation:
+                continue
+            if not b.breakpoint.is_valid():
+                self.breakpoints.remove(b)
+                continue
+            prev = b.addr
+            if b.breakpoint.location.startswith("*"):
+                l = re.sub("[()*]+", "", b.breakpoint.location)
+                lpc = long(l, 0)
+                b.addr = (lpc + offset) % mod
+            else:
+                b.addr = (b.addr + offset) % mod
+            b.relocated = offset
+            if b in self.breakpoints:
+                self.breakpoints.readdress(b, prev)
+            old.append(b.breakpoint)
+            b.breakpoint = CompanionBreakpoint("*(0x%x)" % b.addr, b)
+            if hasattr(b, '_move'):
+                b._move(offset, mod, delorig)
+        if delorig:
+            self._disable_and_delete(old)
 
     def install_plugin(self, p):
         sys.path = [os.path.dirname(p)] + sys.path
@@ -628,6 +878,7 @@ class GDBTargetController(object):
             global capstone
             global caparm
             global r2
+            global trace_writer
             import unicorn
             import unicorn.arm_const as uniarm
             import capstone
@@ -635,7 +886,7 @@ class GDBTargetController(object):
             import r2_keeper as r2
             import ia
             if not self.run_standalone:
-                import substage, staticanalysis, doit_manager, db_info
+                import substage, staticanalysis, doit_manager, db_info, trace_writer
                 import testsuite_utils as utils
             import pure_utils
             import unicorn_utils
@@ -658,6 +909,7 @@ class GDBTargetController(object):
             return
         self.gone = True
         gdb.events.exited.connect(self.gdb_exit)
+        gdb.events.cont.connect(self.clear_reg_cache)
         self.finalize(args)
         if not self.run_standalone:
             stage = self.stage_order[0]
@@ -698,6 +950,7 @@ class CompanionBreakpoint(gdb.Breakpoint):
         gdb.Breakpoint.__init__(self, spec, internal=True)
 
     def stop(self):
+        self.companion.controller.clear_reg_cache()
         self.companion.controller.set_mode()
         ret = self._stop()
         return ret
@@ -728,29 +981,12 @@ class TargetBreak(object):
                 spec = "*(%s)" % spec
         self.addr = controller.spec_to_addr(spec)
         self.breakpoint = CompanionBreakpoint(spec, self)
-        if any(map(lambda x: self.name == x, controller.disabled_breakpoints)):
+        if self.name in controller.disabled_breakpoints:
             controller.disable_breakpoint(self, delete=False)
-        controller.breakpoints.append(self)
+        controller.breakpoints.add(self)
 
     def move(self, offset, mod, delorig=False):
-        if self.needs_relocation:
-            if not self.breakpoint.is_valid():
-                self.controller.breakpoints.remove(self)
-                return
-            if self.breakpoint.location.startswith("*"):
-                l = re.sub("[()*]+", "", self.breakpoint.location)
-                lpc = long(l, 0)
-                self.addr = (lpc + offset) % mod
-            else:
-                self.addr = (self.addr + offset) % mod
-            spec = "*(0x%x)" % self.addr
-            # self.controller.gdb_print("relocating %s to %s\n" % (self, spec))
-            self.relocated = offset
-            if delorig:
-                self.controller.disable_breakpoint(self)
-            self.breakpoint = CompanionBreakpoint(spec, self)
-            if hasattr(self, '_move'):
-                self._move(offset, mod, delorig)
+        self.controller.relocate_breaks([self], offset, mod, delorig)
 
     def msg(self, m):
         self.controller.gdb_print(m)
@@ -791,6 +1027,7 @@ class TargetFinishBreakpoint(gdb.FinishBreakpoint, TargetBreak):
         self.breakpoint = gdb.FinishBreakpoint.__init__(self, internal=True)
 
     def stop(self):
+        self.controller.clear_reg_cache()
         self.controller.set_mode()
         ret = False
         if hasattr(self, '_stop'):
@@ -809,11 +1046,13 @@ class ReturnBreak(TargetBreak):
 
     def _stop(self, bp, ret):
         gdb.execute("return")
+        self.controller.clear_reg_cache()
         return False
 
 
 class WriteBreak(TargetBreak):
-    def __init__(self, spec, controller, stage):
+    def __init__(self, spec, controller, stage, evaluator=None):
+        self.evaluator = evaluator
         if not isinstance(spec, str):
             spec = "*(0x%x)" % spec
         self.emptywrite = {'start': None,
@@ -825,23 +1064,52 @@ class WriteBreak(TargetBreak):
                            'pc': None}
         self.writeinfo = self.emptywrite
         TargetBreak.__init__(self, spec, controller, True, stage)
+        controller.write_pcs.add(self.addr)
+
+    def _move(self, offset, mod, delorig):
+        self.controller.write_pcs.add(self.addr)
 
     def _stop(self, bp, ret):
         cont = self.controller
         if cont.calculate_write_dst:
             self.writeinfo = self.emptywrite
-            pc = cont.get_reg_value('pc', True)
-            inspc = pc - self.relocated
-            cpsr = cont.get_reg_value("cpsr", True)
+            e = self.evaluator
+            needed = e.regs if e is not None else []
+            # lr too, the write hooks log it
+            values = cont.get_reg_values(['pc', 'cpsr', 'lr'] + needed)
+            (pc, cpsr) = values[:2]
             thumb = cont.ia.is_thumb(cpsr)
-            i = cont.get_instr_value(pc, thumb)
-            ins = cont.ia.disasm(i, thumb, inspc, True)
-            row = db_info.get(self.stage).pc_writes_info(inspc)
-            size = row['writesize']
-            needed_regs = [row['reg0'], row['reg1'], row['reg2'], row['reg3']]
-            regs = []
-            for r in filter(lambda x: len(x) > 0, needed_regs):
-                regs.append(cont.get_reg_value(r, True))
+            inspc = pc - self.relocated
+            # the evaluator is only good for the instruction it was built from
+            changed = pc in cont.code_written
+            if e is not None and not changed:
+                if not e.will_happen(values[3:]):
+                    return False  # condition failed, nothing is written
+                (start, end) = e(values[3:])
+                cont.check_code_write(start, end)
+                self.writeinfo = {
+                    'pc': pc,
+                    'start': start,
+                    'end': end,
+                    'cpsr': cpsr,
+                    'thumb': thumb,
+                    'i': cont.get_instr_value(pc, thumb, self.stage, inspc),
+                    'ins': None,
+                }
+                return False
+            i = cont.get_instr_value(pc, thumb, self.stage, inspc)
+            ins = cont.ia.disasm(i, thumb, inspc, not changed)
+            if changed:
+                size = cont.ia.calculate_store_size(ins)
+                needed_regs = cont.ia.needed_regs(ins)
+            else:
+                row = db_info.get(self.stage).pc_writes_info(inspc)
+                size = row['writesize']
+                needed_regs = [row['reg0'], row['reg1'], row['reg2'], row['reg3']]
+            # this stop's snapshot was read from the target already
+            regs = cont.get_reg_values(filter(lambda x: len(x) > 0, needed_regs))
+            if not cont.ia.store_will_happen(ins, regs):
+                return False
             dst = cont.ia.calculate_store_offset(ins, regs)
             if size < 0:  # (ie. push instruction)
                 end = dst
@@ -849,6 +1117,7 @@ class WriteBreak(TargetBreak):
             else:
                 start = dst
                 end = dst + size
+            cont.check_code_write(start, end)
             self.writeinfo = {
                 'pc': pc,
                 'start': start,
@@ -973,39 +1242,31 @@ class LongwriteBreak(TargetBreak):
         self.contaddr = r['contaddr']
         self.writeaddr = r['writeaddr']
         self.thumb = r['thumb']
-        r2.gets(stage.elf, "s 0x%x" % self.writeaddr)
         if self.thumb:
             self.emu = unicorn.Uc(unicorn.UC_ARCH_ARM, unicorn.UC_MODE_THUMB)
-            r2.gets(stage.elf, "ahb 16")
-            r2.gets(stage.elf, "e asm.bits=16")
             self.cs = capstone.Cs(capstone.CS_ARCH_ARM, capstone.CS_MODE_THUMB)
         else:
             self.emu = unicorn.Uc(unicorn.UC_ARCH_ARM, unicorn.UC_MODE_ARM)
-            r2.gets(stage.elf, "ahb 32")
-            r2.gets(stage.elf, "e asm.bits=32")
             self.cs = capstone.Cs(capstone.CS_ARCH_ARM, capstone.CS_MODE_ARM)
-        r2.get(stage.elf, "pdj 1")
 
         self.cs.detail = True
-        self.info = staticanalysis.LongWriteInfo(stage.elf, r['start'],
-                                                 r['end'], self.thumb)
-        self.inss = []
+        # basic blocks were captured during static analysis
+        self.inss = db_info.get(stage).longwrite_blocks(self.breakaddr)
         self.regs = set()
         self.bytes = b""
         self.dst_addrs = []
         self.write_size = r['writesize']
-        for i in self.info.bbs:
-            self.inss.append(i)
-            bs = i["bytes"].decode("hex")
-            self.bytes += b"%s" % bs
-            ci = next(self.cs.disasm(bs, i["offset"], 1))
-            if i["offset"] == self.writeaddr:
+        for i in self.inss:
+            bs = i['ivalue']
+            self.bytes += bs
+            ci = next(self.cs.disasm(bs, i['addr'], 1))
+            if i['addr'] == self.writeaddr:
                 self.write_ins = ci
             (read, write) = ci.regs_access()
             for rs in (read, write):
                 self.regs.update([ci.reg_name(rn).encode('ascii') for rn in rs])
         self.emu.mem_map(0, 0xFFFFFFFF + 1, unicorn.UC_PROT_ALL)
-        self.emu.mem_write(self.inss[0]["offset"], self.bytes)
+        self.emu.mem_write(self.inss[0]['addr'], self.bytes)
         self.emu.hook_add(unicorn.UC_HOOK_MEM_WRITE, self.write_hook)
         self.spec = "*(0x%x)" % r['breakaddr']
         TargetBreak.__init__(self, self.spec, controller, True, stage, r=r)
@@ -1019,8 +1280,8 @@ class LongwriteBreak(TargetBreak):
             self.writeinfo = self.emptywrite
             if self.controller.isbaremetal:
                 gdb.execute("mon gdb_sync")
-            for r in self.regs:
-                v = self.controller.get_reg_value(r, True)
+            regs = list(self.regs)
+            for (r, v) in zip(regs, self.controller.get_reg_values(regs, True)):
                 reg_num = unicorn_utils.reg_val(r)
                 self.emu.reg_write(reg_num, v)
             start = self.breakaddr
@@ -1057,12 +1318,13 @@ class RelocBreak(TargetBreak):
     def _stop(self, bp, ret):
         self.controller.gdb_print("relocating breakpoints\n")
         controller = self.controller
-        for bp in self.controller.breakpoints:
-            if bp.needs_relocation:
-                if self.addr_in_reloc_range(bp.addr):
-                    bp.move(self.reloffset, self.relmod, True)
-            else:
-                continue
+        start = time.time()
+        bps = controller.breakpoints.in_range(self.startaddr, self.startaddr + self.size)
+        controller.relocate_breaks(bps, self.reloffset, self.relmod, True)
+        controller.gdb_print("relocated %d breakpoints in %fs\n" % (len(bps), time.time() - start))
+        if controller.isbaremetal:
+            controller.stage_core_states(self.stage).relocate(self.startaddr, self.size,
+                                                              self.reloffset, self.relmod)
         # make sure final breakpoint is still enabled
         controller.enable_current_stage_end_break()
         controller.gdb_print("continuing execution\n")
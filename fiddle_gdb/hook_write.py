@@ -24,9 +24,12 @@ import gdb
 import time
 import os
 import sys
+import atexit
+import numpy
 import gdb_tools
 from gdb_tools import *
 import db_info
+import database
 
 now = False
 db_written = False
@@ -49,9 +52,10 @@ class WriteLog():
 
 
 class FlushDatabase():
-    def __init__(self, stage, for_now=False):
+    def __init__(self, stage, for_now=False, writer=None):
         self.stage = stage
         self.called = False
+        self.writer = writer
         global now
         if now or for_now:
             self.do()
@@ -63,7 +67,10 @@ class FlushDatabase():
             return
         global start
         gdb.flush()
-        db_info.get(self.stage).flush_tracedb()
+        if self.writer:
+            self.writer.flush(self.stage)
+        else:
+            db_info.get(self.stage).flush_tracedb()
         stop = time.time()
         gdb.write(".. finished in %f minutes\n" % ((stop-start)/60), gdb.STDOUT)
         db_written = True
@@ -116,6 +123,66 @@ class WriteDatabase():
             self.do()
 
 
+class WriteBuffer():
+    # traced writes collected in a preallocated record array and handed
+    # to the database a batch at a time. A batch only holds writes from
+    # one stage and substage. A buffer that is written to while gdb's event
+    # loop can't run (e.g. from an emulator's hooks) sends full batches now
+    def __init__(self, rows, writer, now=False):
+        self.writer = writer  # a trace_writer writer or stand-in
+        self.now = now
+        self.records = numpy.zeros(rows, dtype=database.TraceTable.write_record_dtype)
+        self.n = 0
+        # a longwrite stands for a whole loop's writes, so far fewer are needed
+        self.longwrites = numpy.zeros(max(1, rows >> 6),
+                                      dtype=database.TraceTable.longwrite_record_dtype)
+        self.nlong = 0
+        self.stage = None
+        self.substage = None
+        self.batches = []  # (stage, records) waiting to be written
+
+    def _switch(self, stage, substage):
+        if (self.n or self.nlong) and \
+           (stage.stagename != self.stage.stagename or substage != self.substage):
+            self.flush()
+        self.stage = stage
+        self.substage = substage
+
+    def add(self, stage, time, pid, size, dest, pc, lr, cpsr, origpc, callindex, substage):
+        self._switch(stage, substage)
+        self.records[self.n] = (time, pid, size, dest, pc, lr, cpsr, origpc,
+                                callindex, substage)
+        self.n += 1
+        if self.n == len(self.records):
+            self.flush()
+
+    def add_longwrite(self, stage, time, pid, start, end, stride, writesize, inplace,
+                      pc, lr, cpsr, origpc, callindex, substage):
+        self._switch(stage, substage)
+        self.longwrites[self.nlong] = (time, pid, start, end, stride, writesize, inplace,
+                                       pc, lr, cpsr, origpc, callindex, substage, self.n)
+        self.nlong += 1
+        if self.nlong == len(self.longwrites):
+            self.flush()
+
+    def flush(self, for_now=False):
+        if self.n or self.nlong:
+            self.batches.append((self.stage, self.records[:self.n].copy(),
+                                 self.longwrites[:self.nlong].copy()))
+            self.n = 0
+            self.nlong = 0
+        global now
+        if now or for_now or self.now:
+            self.write()
+        elif self.batches:
+            gdb.post_event(self.write)
+
+    def write(self):
+        while self.batches:
+            (stage, records, longwrites) = self.batches.pop(0)
+            self.writer.send(stage, records, longwrites)
+
+
 class HookWrite(gdb_tools.GDBPlugin):
     def __init__(self):
         bp_hooks = {'WriteBreak': self.write_stophook,
@@ -132,10 +199,15 @@ class HookWrite(gdb_tools.GDBPlugin):
                                      parser_args=parser_options)
 
     def f_hook(self, args):
-        for s in self.controller.stage_order:
-            db_info.create(s, "tracedb")
+        from config import Main
+        self.writer = self.controller.start_trace_writer()
+        self.buffer = WriteBuffer(Main.trace_write_buffer_rows, self.writer)
+        # registered after the writer's and db_info's, so it runs before they close
+        atexit.register(self.buffer.flush, True)
 
     def write_stophook(self, bp, ret):
+        if bp.writeinfo['start'] is None:  # a conditional store that didn't happen
+            return False
         self.process_write(bp.writeinfo,
                            bp.relocated,
                            bp.stage,
@@ -155,22 +227,18 @@ class HookWrite(gdb_tools.GDBPlugin):
         lr = bp.controller.get_reg_value('lr')
         cpsr = bp.controller.get_reg_value('cpsr')
         pid = 2
-        # gdb.post_event(WriteLog("\n<%x longwrite...\n" % writepc))
         if bp.relocated > 0:
             pid = 3
-        for i in range(start, end, bp.writesize):
-            waddr = i
-            if bp.inplace:
-                waddr = start
-
-            self.dowriteinfo(waddr, bp.writesize, writepc,
-                             lr, cpsr, pid, writepc - bp.relocated,
-                             bp.stage, num, name)
-        # gdb.post_event(WriteLog(">\n"))
+        # one record for the whole loop, database.TraceTable.expand_longwrites
+        # turns it back into a write per word for anything that wants that
+        self.buffer.add_longwrite(bp.stage, time.time(), pid, start, end,
+                                  bp.writesize, bp.writesize, bp.inplace,
+                                  writepc, lr, cpsr, writepc - bp.relocated,
+                                  getattr(controller, "call_count", 0), num)
         return False
 
     def stage_finish(self, now=False):
-        fd = FlushDatabase(self.controller.current_stage)
+        fd = FlushDatabase(self.controller.current_stage, writer=self.writer)
         gdb.flush()
         if now:
             fd()
@@ -178,14 +246,18 @@ class HookWrite(gdb_tools.GDBPlugin):
             gdb.post_event(fd)
 
     def _exit_hook(self, event):
+        self.buffer.flush(True)
         self.stage_finish(True)
 
     def endstop_hook(self, bp, ret):
+        self.buffer.flush()
         self.stage_finish()
         return True
 
     def flushall(self, args):
-        gdb.post_event(FlushDatabase(self.controller.current_stage, now=True))
+        self.buffer.flush(True)
+        gdb.post_event(FlushDatabase(self.controller.current_stage, for_now=True,
+                                     writer=self.writer))
 
     def process_write(self, writeinfo, relocated, stage, substage, name):
         pc = writeinfo['pc']
@@ -205,11 +277,8 @@ class HookWrite(gdb_tools.GDBPlugin):
             ccount = self.controller.call_count
         else:
             ccount = 0
-        
-        gdb.post_event(WriteDatabase(time.time(),
-                                     pid, size, writedst, pc, lr,
-                                     cpsr, origpc, stage, substage,
-                                     name, ccount))
+        self.buffer.add(stage, time.time(), pid, size, writedst, pc, lr,
+                        cpsr, origpc, ccount, substage)
 
 
 plugin_config = HookWrite()
@@ -26,7 +26,6 @@ import os
 import sys
 import gdb_tools
 from gdb_tools import *
-import db_info
 import unicorn
 from config import Main
 import hook_write
@@ -287,8 +286,8 @@ class Unicorn(gdb_tools.GDBPlugin):
 
     def setup_emulator(self):
         # init register values
-        for r in self.machine.initregs:
-            regval = self.controller.get_reg_value(r, True)
+        initregs = list(self.machine.initregs)
+        for (r, regval) in zip(initregs, self.controller.get_reg_values(initregs, True)):
             regnum = self.machine.get_reg_id(r)
             self.emu.reg_write(regnum, regval)
 
@@ -363,10 +362,10 @@ class Unicorn(gdb_tools.GDBPlugin):
         gdb.execute("set $%s = 0x%x" % (self.machine.pc_name, pc), to_string=True)
         gdb.execute("x/2i $pc")
         gdb.execute("si")
+        self.controller.clear_reg_cache()
 
         # copy reg values (results) from gdb to emu
-        for r in reg_names:
-            val = self.controller.get_reg_value(r, True)
+        for (r, val) in zip(reg_names, self.controller.get_reg_values(list(reg_names), True)):
             emu.reg_write(self.machine.get_reg_id(r), val)
 
         # copy stack frame from gdb to emu
@@ -416,18 +415,8 @@ class Unicorn(gdb_tools.GDBPlugin):
             print self.emu.__dict__
             print dir(self.emu)
             raise Exception
-        gdb.post_event(hook_write.WriteDatabase(t,
-                                                0,
-                                                size,
-                                                addr,
-                                                pc,
-                                                lr,
-                                                cspr,
-                                                pc,
-                                                self.stage,
-                                                self.substage_num,
-                                                "",
-                                                True))
+        self.buffer.add(self.stage, t, 0, size, addr, pc, lr, cspr, pc, 0,
+                        self.substage_num)
 
     def init(self):
         self.stage = self.controller.stage_order[0]
@@ -435,16 +424,19 @@ class Unicorn(gdb_tools.GDBPlugin):
         self.substage_entries = [utils.get_symbol_location(sub, self.stage)
                                  for sub in
                                  self.controller._stages[self.stage.stagename].substages_entrypoints]
-        db_info.create(self.stage, "tracedb")
+        # the trace writer creates the tracedb and does all of its HDF5 work
+        self.writer = self.controller.start_trace_writer()
+        self.buffer = hook_write.WriteBuffer(Main.trace_write_buffer_rows, self.writer,
+                                             now=True)
         self.create_emulator()
         self.setup_emulator()
         self.emu.emu_start(long(self.stage.entrypoint, 0),
                            self.stage.exitpc)
         global start
         gdb.flush()
-        db_info.get(self.stage).flush_tracedb()
-        gdb.post_event(hook_write.FlushDatabase(self.stage, True))
-        db_info.get(self.stage).update_static_entries()
+        self.buffer.flush(True)
+        hook_write.FlushDatabase(self.stage, True, self.writer)
+        self.writer.call(self.stage, "update_static_entries")
 
     def f_init(self, args):
         if self._no_run: